@@ -0,0 +1,227 @@
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+# pandas and the pipeline modules are only imported by the methods that build or read artifacts, so finding the
+# current builds and reading their metadata (what the dashboard renders first) doesn't have to load them.
+pyarrow_installed = importlib.util.find_spec('pyarrow') is not None
+
+
+def cached_master_seasons(data_dir='Data'):
+    '''
+    :param data_dir: directory of the season masters (see DataUtility.master_path).
+    :return: sorted list of seasons that have both season masters cached, in either format. Only lists file names,
+        so seasons without a build can be offered before the pipeline modules are imported.
+    '''
+    file_names = set(os.listdir(data_dir)) if os.path.isdir(data_dir) else set()
+    years = set()
+    for file_name in file_names:
+        year, _, rest = file_name.partition('_')
+        if year.isdigit() and rest in ('laps_master.parquet', 'laps_master.csv'):
+            if {f'{year}_session_master.parquet', f'{year}_session_master.csv'} & file_names:
+                years.add(int(year))
+    return sorted(years)
+
+
+class ArtifactStore:
+    """
+    Versioned, ready to serve analysis artifacts for each season, built offline so the dashboard never has to
+    fetch or run the pipeline itself.
+
+    Layout, under root (Data/artifacts by default):
+        {year}/{build_id}/*.parquet + manifest.json    one directory per build, never modified once written
+        {year}/{build_id}/metadata.json                 the season's drivers and tracks, enough to lay out the dashboard
+        {year}/current.json                            the build currently served, swapped atomically
+    A build is written to a temporary directory and only becomes current once complete, so readers only ever see
+    whole builds. The previous builds are kept (up to keep_builds) so a dashboard still reading one isn't broken.
+    Builds with a different artifact_version than the running code are ignored.
+    """
+    artifact_version = 3
+    keep_builds = 2
+    # name -> whether the frame's index is meaningful and must be stored. Only what the dashboard reads is written,
+    # the season's laps themselves go to the lap store (DataUtility.write_lap_store).
+    artifacts = {'metric_partials': True,     # per driver/track metric cube partials (DataFormatter.metric_partials)
+                 'degradation_partials': True}  # per driver/track degradation model partials (DataFormatter.degradation_partials)
+
+    def __init__(self, root='Data/artifacts'):
+        self.root = root
+
+    def season_dir(self, year):
+        return os.path.join(self.root, str(year))
+
+    def current_build(self, year):
+        '''
+        :param year: season.
+        :return: manifest of the build currently served for the season, or None if there is no usable build.
+        '''
+        pointer = os.path.join(self.season_dir(year), 'current.json')
+        if not pyarrow_installed or not os.path.exists(pointer):
+            return None
+        with open(pointer) as f:
+            build_id = json.load(f)['build_id']
+        manifest_path = os.path.join(self.season_dir(year), build_id, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('artifact_version') != self.artifact_version:
+            return None
+        return manifest
+
+    def built_seasons(self):
+        '''
+        :return: sorted list of seasons with a current build.
+        '''
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(year) for year in os.listdir(self.root)
+                      if year.isdigit() and self.current_build(year) is not None)
+
+    def load_metadata(self, years, build_ids):
+        '''
+        :param years: seasons to describe.
+        :param build_ids: build of each season, from current_builds.
+        :return: {'drivers': [...], 'tracks': [...]} across the seasons, in order of first appearance,
+            or None if a build has no metadata.
+        '''
+        drivers, tracks = {}, {}
+        for year, build_id in zip(years, build_ids):
+            path = os.path.join(self.season_dir(year), build_id, 'metadata.json')
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                metadata = json.load(f)
+            drivers.update(dict.fromkeys(metadata['drivers']))
+            tracks.update(dict.fromkeys(metadata['tracks']))
+        return {'drivers': list(drivers), 'tracks': list(tracks)}
+
+    def current_build_id(self, year):
+        '''
+        :return: id of the build currently served for the season, or None if there is no usable build.
+        '''
+        manifest = self.current_build(year)
+        return manifest['build_id'] if manifest else None
+
+    def current_builds(self, years):
+        '''
+        :return: tuple of the current build id of each season, or None if any season has no usable build.
+        '''
+        manifests = [self.current_build(year) for year in years]
+        if any(m is None for m in manifests):
+            return None
+        return tuple(m['build_id'] for m in manifests)
+
+    def build_season(self, year, refresh=False):
+        '''
+        Run the whole pipeline for a season and publish its artifacts as the season's current build.
+        :param year: season to build.
+        :param refresh: if True, refresh the season masters from the api first (see DataUtility.refresh_season_masters).
+        :return: manifest of the new build.
+        '''
+        if not pyarrow_installed:
+            raise RuntimeError('Building artifacts needs pyarrow installed.')
+        from data_import import DataUtility
+        from data_formatter import DataFormatter
+
+        du = DataUtility()
+        dc = DataFormatter()
+        start = time.perf_counter()
+
+        season_df = du.get_all_laps_and_sessions_per_year_df(year, refresh=refresh)
+        lapdf = dc.normalize_lap_times(dc.remove_invalid_lap_times(season_df))
+        stint_summary = dc.stint_summary_df(season_df)
+        lap_time_partials, degradation_partials = dc.lap_partials(lapdf)
+        frames = {'metric_partials': dc.metric_partials(stint_summary, lap_time_partials),
+                  'degradation_partials': degradation_partials}
+
+        build_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        season_dir = self.season_dir(year)
+        build_dir = os.path.join(season_dir, build_id)
+        tmp_dir = build_dir + '.tmp'
+        os.makedirs(tmp_dir)
+        try:
+            for name, df in frames.items():
+                df.to_parquet(os.path.join(tmp_dir, name + '.parquet'), index=self.artifacts[name])
+            manifest = {'artifact_version': self.artifact_version,
+                        'build_id': build_id,
+                        'year': year,
+                        'built_at': datetime.now().astimezone().isoformat(),
+                        'build_seconds': round(time.perf_counter() - start, 3),
+                        'laps': len(lapdf),
+                        'stints': len(stint_summary),
+                        'rows': {name: len(df) for name, df in frames.items()}}
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            # In order of first appearance, the order the dashboard lists them in.
+            metadata = {'drivers': season_df['driver_name'].dropna().unique().tolist(),
+                        'tracks': season_df['track_name'].dropna().unique().tolist()}
+            with open(os.path.join(tmp_dir, 'metadata.json'), 'w') as f:
+                json.dump(metadata, f)
+            os.rename(tmp_dir, build_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        pointer = os.path.join(season_dir, 'current.json')
+        with open(pointer + '.tmp', 'w') as f:
+            json.dump({'build_id': build_id}, f)
+        os.replace(pointer + '.tmp', pointer)
+        self.prune_builds(year)
+        # The same frames feed the lap store ad hoc queries are answered from (DataUtility.query_laps).
+        du.write_lap_store(year, season_df, lapdf)
+        return manifest
+
+    def prune_builds(self, year):
+        season_dir = self.season_dir(year)
+        builds = sorted(d for d in os.listdir(season_dir)
+                        if os.path.isdir(os.path.join(season_dir, d)) and not d.endswith('.tmp'))
+        for build_id in builds[:-self.keep_builds]:
+            shutil.rmtree(os.path.join(season_dir, build_id), ignore_errors=True)
+
+    def read_artifact(self, year, build_id, name):
+        import pandas as pd
+        # Memory mapped so the file is decoded straight from the os file cache rather than read into a buffer first.
+        # The decoded frame is still the process's own copy.
+        return pd.read_parquet(os.path.join(self.season_dir(year), build_id, name + '.parquet'), memory_map=True)
+
+    def load_partials(self, year, build_id):
+        '''
+        Load the partials the dashboard serves a season from.
+        :param year: season to load.
+        :param build_id: build of the season to load, from current_build_id.
+        :return: metric_partials, degradation_partials of the season. The frames are shared and must not be modified.
+        '''
+        return self.read_artifact(year, build_id, 'metric_partials'), self.read_artifact(year, build_id, 'degradation_partials')
+
+
+def build_season_artifacts(year, root, refresh=False):
+    '''
+    Process pool entry point for building one season's artifacts.
+    '''
+    return ArtifactStore(root).build_season(year, refresh=refresh)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the masters, lap store and analysis artifacts served by the dashboard, one process per season.')
+    parser.add_argument('years', type=int, nargs='+', help='seasons to build')
+    parser.add_argument('--refresh', action='store_true', help='check the api for new or changed sessions first')
+    parser.add_argument('--processes', type=int, default=None, help='maximum seasons built at once (default: one per cpu)')
+    parser.add_argument('--root', default='Data/artifacts', help='artifact directory')
+    args = parser.parse_args()
+
+    years = sorted(set(args.years))
+    processes = min(len(years), args.processes or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        manifests = list(pool.map(build_season_artifacts, years, [args.root] * len(years), [args.refresh] * len(years)))
+    for manifest in manifests:
+        print(f"{manifest['year']}: build {manifest['build_id']} in {manifest['build_seconds']}s, "
+              f"{manifest['laps']} laps, {manifest['stints']} stints")
+
+
+if __name__ == '__main__':
+    main()
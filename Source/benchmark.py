@@ -0,0 +1,448 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from data_import import DataUtility
+from data_formatter import DataFormatter
+from frame_index import DriverTrackIndex
+
+
+class SyntheticSeasonGenerator:
+    """
+    Generates fake seasons of any size, shaped exactly like the OpenF1 api data and the season masters built from it.
+    Lap times follow a rough race model (track base time, fuel burn, tire wear, noise) with the things the
+    cleaning steps look for mixed in: outlier laps, missing times, pit out laps and field wide slow laps.
+    """
+    tracks = [('Sakhir', 'Bahrain', 57), ('Jeddah', 'Saudi Arabia', 50), ('Melbourne', 'Australia', 58),
+              ('Baku', 'Azerbaijan', 51), ('Miami', 'United States', 57), ('Monte Carlo', 'Monaco', 78),
+              ('Catalunya', 'Spain', 66), ('Montreal', 'Canada', 70), ('Spielberg', 'Austria', 71),
+              ('Silverstone', 'Great Britain', 52), ('Hungaroring', 'Hungary', 70), ('Spa-Francorchamps', 'Belgium', 44),
+              ('Zandvoort', 'Netherlands', 72), ('Monza', 'Italy', 51), ('Singapore', 'Singapore', 62),
+              ('Suzuka', 'Japan', 53), ('Lusail', 'Qatar', 57), ('Austin', 'United States', 56),
+              ('Mexico City', 'Mexico', 71), ('Interlagos', 'Brazil', 71), ('Las Vegas', 'United States', 50),
+              ('Yas Marina Circuit', 'United Arab Emirates', 58)]
+    sprint_tracks = ['Baku', 'Spielberg', 'Spa-Francorchamps', 'Lusail', 'Austin', 'Interlagos']
+    compounds = ['SOFT', 'MEDIUM', 'HARD', 'INTERMEDIATE']
+    compound_weights = [0.25, 0.4, 0.3, 0.05]
+    # Seconds lost per lap of tire age, per compound.
+    compound_wear = {'SOFT': 0.09, 'MEDIUM': 0.06, 'HARD': 0.04, 'INTERMEDIATE': 0.07}
+
+    def __init__(self, seasons=1, drivers=20, first_year=None, seed=0):
+        """
+        :param seasons: number of seasons to generate.
+        :param drivers: number of drivers per session.
+        :param first_year: first season generated, by default chosen so every season is already over.
+        :param seed: random seed, the same arguments always generate the same data.
+        """
+        self.years = list(range(first_year or datetime.now().year - seasons, (first_year or datetime.now().year - seasons) + seasons))
+        self.drivers = drivers
+        self.rng = np.random.default_rng(seed)
+
+    def generate(self):
+        """
+        :return: dict of api shaped frames: {'sessions', 'drivers', 'stints', 'laps'}, covering every season.
+        """
+        sessions, drivers, stints, laps = [], [], [], []
+        for year in self.years:
+            for frames, new in zip((sessions, drivers, stints, laps), self.generate_season(year)):
+                frames.append(new)
+        return {'sessions': pd.concat(sessions, ignore_index=True),
+                'drivers': pd.concat(drivers, ignore_index=True),
+                'stints': pd.concat(stints, ignore_index=True),
+                'laps': pd.concat(laps, ignore_index=True)}
+
+    def generate_season(self, year):
+        season_start = pd.Timestamp(f'{year}-03-05 15:00', tz='UTC')
+        driver_numbers = np.arange(1, self.drivers + 1)
+        driver_names = [f'Driver{n:02d} SYNTHETIC' for n in driver_numbers]
+        driver_shorts = [f'D{n:02d}' for n in driver_numbers]
+        team_names = [f'Team {(n - 1) // 2 + 1}' for n in driver_numbers]
+
+        session_rows, driver_frames, stint_frames, lap_frames = [], [], [], []
+        for race, (track, country, race_laps) in enumerate(self.tracks):
+            meeting_key = (year - 2000) * 100 + race
+            race_start = season_start + pd.Timedelta(weeks=race)
+            weekend = [('Race', race_start, race_laps)]
+            if track in self.sprint_tracks:
+                weekend.append(('Sprint', race_start - pd.Timedelta(days=1), race_laps // 3))
+            for session_name, date_start, total_laps in weekend:
+                session_key = meeting_key * 10 + len(session_rows) % 10
+                session_rows.append({'session_key': session_key, 'session_name': session_name,
+                                     'date_start': date_start.isoformat(),
+                                     'date_end': (date_start + pd.Timedelta(hours=2)).isoformat(),
+                                     'session_type': 'Race', 'meeting_key': meeting_key,
+                                     'circuit_short_name': track, 'country_name': country, 'year': year})
+                driver_frames.append(pd.DataFrame({'meeting_key': meeting_key, 'session_key': session_key,
+                                                   'driver_number': driver_numbers, 'full_name': driver_names,
+                                                   'name_acronym': driver_shorts, 'team_name': team_names,
+                                                   'team_colour': '3671C6'}))
+                stintdf = self.generate_stints(meeting_key, session_key, driver_numbers, total_laps, session_name)
+                stint_frames.append(stintdf)
+                lap_frames.append(self.generate_laps(meeting_key, session_key, date_start, total_laps, stintdf))
+        return (pd.DataFrame(session_rows), pd.concat(driver_frames, ignore_index=True),
+                pd.concat(stint_frames, ignore_index=True), pd.concat(lap_frames, ignore_index=True))
+
+    def generate_stints(self, meeting_key, session_key, driver_numbers, total_laps, session_name):
+        rng = self.rng
+        rows = []
+        for driver_number in driver_numbers:
+            # Roughly one in ten drivers doesn't finish.
+            laps_done = total_laps if rng.random() > 0.1 else int(rng.integers(1, total_laps + 1))
+            max_stops = 1 if session_name == 'Sprint' else 3
+            stops = min(int(rng.integers(0, max_stops + 1)), laps_done - 1)
+            ends = np.sort(rng.choice(np.arange(1, laps_done), size=stops, replace=False)) if stops else np.array([], dtype=int)
+            starts = np.concatenate([[1], ends + 1])
+            ends = np.concatenate([ends, [laps_done]])
+            for stint_number, (lap_start, lap_end) in enumerate(zip(starts, ends), start=1):
+                rows.append((meeting_key, session_key, stint_number, driver_number, int(lap_start), int(lap_end),
+                             rng.choice(self.compounds, p=self.compound_weights), float(rng.integers(0, 4))))
+        return pd.DataFrame(rows, columns=['meeting_key', 'session_key', 'stint_number', 'driver_number',
+                                           'lap_start', 'lap_end', 'compound', 'tyre_age_at_start'])
+
+    def generate_laps(self, meeting_key, session_key, date_start, total_laps, stintdf):
+        rng = self.rng
+        stint_laps = (stintdf['lap_end'] - stintdf['lap_start'] + 1).to_numpy()
+        rows = np.repeat(np.arange(len(stintdf)), stint_laps)
+        lap_in_stint = np.arange(len(rows)) - np.repeat(np.cumsum(stint_laps) - stint_laps, stint_laps)
+        lap_number = stintdf['lap_start'].to_numpy()[rows] + lap_in_stint
+        compound = stintdf['compound'].to_numpy()[rows]
+        wear = np.array([self.compound_wear[c] for c in compound])
+        tire_age = stintdf['tyre_age_at_start'].to_numpy()[rows] + lap_in_stint
+
+        base = 75 + (session_key % 25)
+        fuel = (110 - (110 / total_laps) * (lap_number - .5)) * .03
+        lap_seconds = base + fuel + wear * tire_age + rng.normal(0, .6, len(rows))
+        is_pit_out_lap = (lap_in_stint == 0) & (stintdf['stint_number'].to_numpy()[rows] > 1)
+        lap_seconds[is_pit_out_lap] += 20
+        lap_seconds[lap_number == 1] += 8
+        # Safety car/yellow flag laps slow the whole field.
+        slow_laps = rng.choice(np.arange(1, total_laps + 1), size=max(1, total_laps // 20), replace=False)
+        lap_seconds[np.isin(lap_number, slow_laps)] *= 1.35
+        lap_seconds[rng.random(len(rows)) < .02] *= 1.5
+        lap_seconds[rng.random(len(rows)) < .01] = np.nan
+
+        sectors = lap_seconds[:, None] * np.array([.32, .36, .32])
+        return pd.DataFrame({'meeting_key': meeting_key,
+                             'session_key': session_key,
+                             'driver_number': stintdf['driver_number'].to_numpy()[rows],
+                             'i1_speed': rng.integers(220, 320, len(rows)),
+                             'i2_speed': rng.integers(200, 300, len(rows)),
+                             'st_speed': rng.integers(250, 340, len(rows)),
+                             'date_start': (date_start + pd.to_timedelta(lap_number * base, unit='s')).map(pd.Timestamp.isoformat),
+                             'lap_duration': lap_seconds,
+                             'is_pit_out_lap': is_pit_out_lap,
+                             'duration_sector_1': sectors[:, 0],
+                             'duration_sector_2': sectors[:, 1],
+                             'duration_sector_3': sectors[:, 2],
+                             'segments_sector_1': '[2049, 2049, 2051, 2049]',
+                             'segments_sector_2': '[2049, 2049, 2049]',
+                             'segments_sector_3': '[2049, 2051, 2049]',
+                             'lap_number': lap_number})
+
+    def masters(self, api_frames=None):
+        """
+        Build season masters from generated api frames, the same way DataUtility.build_master_rows does.
+        :param api_frames: frames from generate(), generated if not given.
+        :return: lapdf, sessiondf masters (api columns renamed, not yet typed).
+        """
+        api_frames = api_frames or self.generate()
+        du = DataUtility
+        sessiondf = api_frames['sessions'].merge(api_frames['drivers'], on=['session_key'])
+        sessiondf = sessiondf.merge(api_frames['stints'], on=['session_key', 'driver_number'])
+        sessiondf['stint_length'] = sessiondf['lap_end'] - sessiondf['lap_start'] + 1
+        sessiondf = sessiondf[du.session_api_columns].rename(columns=du.session_api_renames)
+        lapdf = api_frames['laps'].rename(columns=du.lap_api_renames)
+        return lapdf, sessiondf
+
+
+class OpenF1StandIn:
+    """
+    Local http server standing in for the OpenF1 api, serving the sessions/laps/drivers/stints endpoints
+    from in memory frames. Query parameters filter on equality (or >=/<= as in lap_number>=10), csv=true returns
+    csv (json otherwise).
+    Responses carry an ETag and honour If-None-Match, and every request can be delayed to simulate latency.
+    Use as a context manager; api_url_base is the value to give DataUtility.api_url_base.
+    """
+    def __init__(self, frames, latency=0.0, port=0):
+        """
+        :param frames: {endpoint: df} of the data to serve, e.g. SyntheticSeasonGenerator.generate().
+        :param latency: seconds to wait before answering each request.
+        :param port: port to listen on, 0 picks a free port.
+        """
+        self.frames = frames
+        self.latency = latency
+        # Most requests filter on one session or year, split the frames by those up front so answering
+        # a request doesn't scan the whole frame.
+        self.partitions = {(endpoint, key): {str(value): part for value, part in df.groupby(key, sort=False)}
+                           for endpoint, df in frames.items() for key in ('session_key', 'year') if key in df.columns}
+        self.request_counts = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.thread = None
+
+    @property
+    def api_url_base(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/v1/'
+
+    def handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                endpoint = url.path.rstrip('/').split('/')[-1]
+                with stand_in.lock:
+                    stand_in.request_counts[endpoint] = stand_in.request_counts.get(endpoint, 0) + 1
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                if endpoint not in stand_in.frames:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = stand_in.respond(endpoint, parse_qs(url.query))
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def respond(self, endpoint, query, df=None):
+        """
+        :param df: frame to filter, rather than the whole endpoint's frame.
+        :return: body of the response.
+        """
+        as_csv = query.pop('csv', ['false'])[0] == 'true'
+        if df is None:
+            df = self.frames[endpoint]
+            for key in ('session_key', 'year'):
+                if key in query and (endpoint, key) in self.partitions:
+                    df = self.partitions[(endpoint, key)].get(query.pop(key)[0], df.iloc[:0])
+                    break
+        for key, values in query.items():
+            if key in df.columns:
+                df = df.loc[df[key].astype(str) == values[0]]
+            elif key[-1:] in ('>', '<') and key[:-1] in df.columns:
+                # lap_number>=10 style filters, which parse as the key 'lap_number>' with the value '10'.
+                column = df[key[:-1]]
+                value = float(values[0]) if pd.api.types.is_numeric_dtype(column) else values[0]
+                df = df.loc[column >= value] if key[-1] == '>' else df.loc[column <= value]
+        if as_csv:
+            return df.to_csv(index=False).encode() if len(df) else b''
+        return df.to_json(orient='records').encode()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SessionReplay(OpenF1StandIn):
+    """
+    OpenF1StandIn that plays a completed session back as if it were running, for testing live mode (see LiveSession).
+
+    The session's laps are revealed against a replay clock, the same way the api reports a running session:
+    a lap shows up once it has started, without a lap time, and gets its lap and sector times once it is over.
+    The clock runs at speed times real time from when the server starts, and can be moved on with advance();
+    with speed=0 it only moves with advance(), for stepping through a session deterministically.
+    Every other endpoint is served as is.
+    """
+    timed_columns = ['lap_duration', 'duration_sector_1', 'duration_sector_2', 'duration_sector_3']
+
+    def __init__(self, frames, session_key, speed=1.0, latency=0.0, port=0):
+        """
+        :param frames: {endpoint: df} of the data to serve, as for OpenF1StandIn.
+        :param session_key: session whose laps are played back, other sessions' laps aren't served.
+        :param speed: replay seconds per real second.
+        """
+        laps = frames['laps']
+        laps = laps.loc[laps['session_key'] == session_key].reset_index(drop=True)
+        super().__init__({**frames, 'laps': laps}, latency=latency, port=port)
+        self.session_key = session_key
+        self.speed = speed
+        self.lap_start = pd.to_datetime(laps['date_start'], format='ISO8601')
+        self.lap_end = self.lap_start + pd.to_timedelta(laps['lap_duration'], unit='s')
+        self.session_start = self.lap_start.min()
+        self.offset = 0.0
+        self.started = time.perf_counter()
+
+    def elapsed(self):
+        """
+        :return: seconds since the start of the session on the replay clock.
+        """
+        return self.offset + (time.perf_counter() - self.started) * self.speed
+
+    def advance(self, seconds):
+        with self.lock:
+            self.offset += seconds
+
+    def finish(self):
+        """
+        Move the clock past the end of the session, so every lap is served with its time.
+        """
+        self.advance(max(0.0, (self.lap_end.max() - self.session_start).total_seconds() + 1 - self.elapsed()))
+
+    def respond(self, endpoint, query):
+        if endpoint != 'laps':
+            return super().respond(endpoint, query)
+        now = self.session_start + pd.to_timedelta(self.elapsed(), unit='s')
+        started = (self.lap_start <= now).to_numpy()
+        laps = self.frames['laps'].loc[started].copy()
+        # Laps that haven't finished yet (or never get a time) are served without their times.
+        laps.loc[~(self.lap_end.loc[started] <= now), self.timed_columns] = np.nan
+        return super().respond(endpoint, query, laps)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return super().__enter__()
+
+
+class BenchmarkRunner:
+    """
+    Runs the pipeline stages over generated data and records wall time, peak traced memory and throughput for each.
+    """
+    def __init__(self, seasons=1, drivers=20, latency=0.0, trace_memory=True, seed=0, processes=None):
+        self.generator = SyntheticSeasonGenerator(seasons=seasons, drivers=drivers, seed=seed)
+        self.latency = latency
+        self.processes = processes
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def measure(self, stage, rows_in, func, *args):
+        """
+        Run one stage, recording its cost. Tracing allocations slows python down considerably, so when memory
+        is traced the stage is run a second time for it and the wall time comes from the untraced run.
+        :param stage: name of the stage.
+        :param rows_in: number of input rows, used for throughput.
+        :return: whatever func returned.
+        """
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = 0
+        if self.trace_memory:
+            tracemalloc.start()
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.results.append({'stage': stage,
+                             'seconds': round(seconds, 4),
+                             'peak_mb': round(peak / 1024 ** 2, 2),
+                             'rows_in': rows_in,
+                             'rows_per_second': round(rows_in / seconds) if seconds else None})
+        return result
+
+    def build_masters(self, du, api):
+        """
+        Full build of every season's masters through the real request path, against the stand-in,
+        in a fresh data directory so nothing is served from a previous run's cache.
+        :return: list of (lapdf, sessiondf) per season.
+        """
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as data_root:
+            os.chdir(data_root)
+            try:
+                os.makedirs('Data', exist_ok=True)
+                du.api_url_base = api.api_url_base
+                return [du.refresh_season_masters(year) for year in self.generator.years]
+            finally:
+                os.chdir(cwd)
+
+    def run(self):
+        api_frames = self.generator.generate()
+        du = DataUtility()
+        df = DataFormatter()
+
+        with OpenF1StandIn(api_frames, latency=self.latency) as api:
+            masters = self.measure('fetch', len(api_frames['laps']), self.build_masters, du, api)
+        lapdf = pd.concat([m[0] for m in masters], ignore_index=True)
+        sessiondf = pd.concat([m[1] for m in masters], ignore_index=True)
+        lapdf = du.apply_master_schema(lapdf, du.lap_master_dtypes)
+        sessiondf = du.apply_master_schema(sessiondf, du.session_master_dtypes)
+
+        masterdf = self.measure('combine_laps_and_session', len(lapdf), du.combine_laps_and_session, lapdf, sessiondf)
+        cleandf = self.measure('remove_invalid_lap_times', len(masterdf), df.remove_invalid_lap_times, masterdf)
+        normdf = self.measure('normalize_lap_times', len(cleandf), df.normalize_lap_times, cleandf)
+        # The same two stages sharded by session across processes, whatever the frame size.
+        parallel_df = DataFormatter()
+        parallel_df.parallel_min_rows = 0
+        self.measure('clean_and_normalize', len(masterdf), parallel_df.clean_and_normalize, masterdf, self.processes)
+        self.measure('analyze_stint_df', len(masterdf), df.analyze_stint_df, masterdf)
+
+        # Filter: the dashboard's selection path, the season's partials built once then a handful of driver/track
+        # selections each combined into the metric cube and refit into degradation curves.
+        def build_filter_index():
+            lap_time_partials, degradation_partials = df.lap_partials(normdf)
+            index = DriverTrackIndex()
+            index.add_partials('metrics', df.metric_partials(df.stint_summary_df(masterdf), lap_time_partials))
+            index.add_partials('degradation', degradation_partials)
+            return index
+        index = self.measure('build_filter_index', len(normdf), build_filter_index)
+        drivers = list(normdf['driver_name'].unique())
+        tracks = list(normdf['track_name'].unique())
+        selections = [(drivers[:1], []), (drivers[:3], tracks[:4]), ([], tracks[:2]), (drivers[::2], tracks[::3])]
+
+        def filter_selections():
+            for driver_filter, track_filter in selections:
+                df.analyze_metric_cube(df.metric_cube(index.select_partials('metrics', driver_filter, track_filter)))
+                df.degradation_curve(df.fit_degradation(index.select_partials('degradation', driver_filter, track_filter),
+                                                        by=('compound',), within=('track_name', 'driver_name')))
+        self.measure('filter_df', len(normdf) * len(selections), filter_selections)
+        return self.results
+
+    def report(self):
+        widths = {'stage': 26, 'seconds': 10, 'peak_mb': 10, 'rows_in': 12, 'rows_per_second': 16}
+        lines = [''.join(name.rjust(width) if name != 'stage' else name.ljust(width) for name, width in widths.items())]
+        for result in self.results:
+            lines.append(''.join((str(result[name]).rjust(width) if name != 'stage' else result[name].ljust(width))
+                                 for name, width in widths.items()))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data pipeline over synthetic seasons.')
+    parser.add_argument('--seasons', type=int, default=1, help='number of seasons to generate (1-20).')
+    parser.add_argument('--drivers', type=int, default=20, help='drivers per session (20-40).')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency added to every api request.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="don't trace peak memory (tracing slows every stage down).")
+    parser.add_argument('--processes', type=int, default=None, help='worker processes for the parallel stages (default: one per cpu).')
+    parser.add_argument('--json', help='also write the results to this file as json.')
+    args = parser.parse_args()
+
+    runner = BenchmarkRunner(seasons=args.seasons, drivers=args.drivers, latency=args.latency,
+                             trace_memory=not args.no_memory, seed=args.seed, processes=args.processes)
+    runner.run()
+    print(runner.report())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(runner.results, f, indent=2)
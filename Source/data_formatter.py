@@ -1,29 +1,54 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from profiling import profiled
 
 
 class DataFormatter:
-    def remove_invalid_lap_times(self, df):
+    # clean_and_normalize only shards frames of at least this many laps across processes, smaller frames are
+    # quicker to do in process than to ship to workers. Each process gets shards_per_process shards to even out
+    # the load, since sessions aren't all the same size.
+    parallel_min_rows = 500000
+    shards_per_process = 2
+    # Terms of the degradation models, in coefficient order. The curve model adds a squared lap_in_stint term
+    # to the straight line slope model.
+    degradation_terms = {'slope': ['intercept', 'lap_in_stint', 'initial_tire_age'],
+                         'curve': ['intercept', 'lap_in_stint', 'lap_in_stint_sq', 'initial_tire_age']}
+
+    @profiled('validity_filter')
+    def remove_invalid_lap_times(self, df, return_mask=False):
         """
         Function to remove invalid, excessively high lap times, as well as pit out laps and laps
         where we infer that a field slowing even occurred (yellow flag, etc...).
 
         :param df: full dataframe of lap times.
+        :param return_mask: if True, don't build the filtered frame, return the keep mask and drop reasons instead.
         :return: new dataframe with invalid lap times removed.
+            If return_mask is True: (mask, reasons), where mask is a boolean series aligned with df that is True
+            for laps that are kept, and reasons is a boolean frame aligned with df with a column for each reason
+            a lap can be dropped ('invalid_lap_time', 'field_slow_lap', 'pit_out_lap').
 
         THIS CAN SKEW PER STINT ANALYSIS.
         This has the potential (and is likely to) cut out whole stints, particularly at the
         beginning of the race, where a driver may pit on the first lap.
         """
-        #
+        # Every step below is a per-group transform aligned with df, so nothing is merged or copied until
+        # the final filter.
 
         # We're doing an arbitrary time calculation to find the limit for outlier laps
-        sddf = (df.groupby(['session_key', 'driver_name'])
-                .agg({'lap_seconds': 'median',
-                      'lap_number': 'count'}))
-        sddf = sddf.rename(columns={'lap_number': 'session_laps'})
-        sddf['valid_lap_threshold'] = sddf['lap_seconds']*1.25
-        sddf = sddf[['session_laps', 'valid_lap_threshold']]
-        dfr = df.merge(sddf, on=['driver_name', 'session_key'])
+        driver_groups = df.groupby(['session_key', 'driver_name'], observed=True, sort=False)
+        valid_lap_threshold = driver_groups['lap_seconds'].transform('median') * 1.25
+        session_laps = driver_groups['lap_number'].transform('count')
+        # Laps missing a session or driver can't be given a threshold, treat them as invalid.
+        has_threshold = df['session_key'].notna() & df['driver_name'].notna()
 
         #Set the total race laps per session. We have to assume this based on lap_number data, since this is not retrievable from the endpoint.
         # We find the maximum number of laps completed, which in almost all cases should be the total laps. Exceptions would be races that got rained out
@@ -31,34 +56,94 @@ class DataFormatter:
         # calculating normalized lap times taking fuel weight into account.
         # If less than 44 laps were completed (the shortest lap count) we assume the lap count is the average (and most common lap count), 57.
         # There is certainly still the possibility of a race being rained out after 44 laps, and not getting the correct total laps, but this is a rare edge case that we ignore.
-        dfs = dfr.groupby('session_key').agg({'session_laps': 'max'})
-        dfs['total_session_laps'] = dfs['session_laps'].apply(lambda x: x if x > 44 else 57)
-        dfr = dfr.merge(dfs, on=['session_key'])
+        max_session_laps = session_laps.groupby(df['session_key'], sort=False).transform('max')
+        total_session_laps = max_session_laps.where(max_session_laps > 44, 57)
 
         # Here we used the calculated outlier lap limit to mark a lap valid or not.
         # We then use the collected lap validity column to find common invalid laps, which might indicates an event (yellow flag, etc..)
         # that caused these specific laps to be slow for multiple drivers. We use the 'field_valid_lap' column to mark these laps.
         # This is necessary because, while yellow flags slow the field considerably, some drivers still put in laps on occasion that
         #   are fast enough to not be filtered by the outlier limit, but are still affected by the slowing event.
-        dfr['lap_validity'] = True
-        dfr.loc[(dfr['lap_seconds'] >= dfr['valid_lap_threshold']) | (dfr['lap_seconds'].isnull()), 'lap_validity'] = False
-        dfvs = dfr.groupby(['session_key', 'lap_number']).agg({'lap_validity': 'sum'})
-        dfvs['field_valid_lap'] = dfvs['lap_validity'] > 10
-        dfvs = dfvs['field_valid_lap']
-        dfr = dfr.merge(dfvs, on=['session_key', 'lap_number'])
+        lap_validity = ~((df['lap_seconds'] >= valid_lap_threshold) | df['lap_seconds'].isnull()) & has_threshold
+        field_valid_lap = lap_validity.groupby([df['session_key'], df['lap_number']], sort=False).transform('sum') > 10
 
         # We now have two columns on df for checking whether a lap is valid:
         # if 'field_valid_lap' is False, something caused over 10 drivers to have a slow lap, so drop it
         #   (this driver may have had an acceptable time, but it's probably slower than normal due to the event and should be filtered)
         # if 'lap_validity' is False, automatically drop the lap
         #   (something specific to this driver caused them to have a slow lap, but it may not have affected any other cars)
-        dfr = dfr.loc[(dfr['lap_validity'] == True) & (dfr['field_valid_lap'] == True)]
-
         #Drop any lap that's a pit out lap automatically, it will be slower (but may not get detected by lap_validity) and not reflect real race times.
-        dfr = dfr.loc[dfr['is_pit_out_lap'] != True]
+        pit_out_lap = df['is_pit_out_lap'] == True
+        mask = lap_validity & field_valid_lap & ~pit_out_lap
+
+        if return_mask:
+            reasons = pd.DataFrame({'invalid_lap_time': ~lap_validity,
+                                    'field_slow_lap': ~field_valid_lap,
+                                    'pit_out_lap': pit_out_lap},
+                                   index=df.index)
+            return mask, reasons
 
+        # Build the filtered frame with the same columns (and the positional index) the merge based version produced.
+        keep = np.flatnonzero(mask.to_numpy())
+        dfr = df.iloc[keep].assign(session_laps_x=session_laps.to_numpy()[keep].astype('int64'),
+                                   valid_lap_threshold=valid_lap_threshold.to_numpy()[keep],
+                                   session_laps_y=max_session_laps.to_numpy()[keep].astype('int64'),
+                                   total_session_laps=total_session_laps.to_numpy()[keep].astype('int64'),
+                                   lap_validity=True,
+                                   field_valid_lap=True)
+        dfr.index = pd.Index(keep)
         return dfr
 
+    @profiled('clean_and_normalize')
+    def clean_and_normalize(self, df, processes=None):
+        """
+        Function to run remove_invalid_lap_times then normalize_lap_times, sharding large frames by session across a
+        process pool. Every group either step uses is scoped by session_key, so each session can be done on its own.
+        Shards are sent to and from the workers as Arrow buffers when pyarrow is available.
+        :param df: full dataframe of lap times.
+        :param processes: maximum worker processes, None uses one per cpu.
+        :return: the same frame normalize_lap_times(remove_invalid_lap_times(df)) returns.
+        """
+        processes = processes or os.cpu_count() or 1
+        if processes == 1 or len(df) < self.parallel_min_rows:
+            return self.normalize_lap_times(self.remove_invalid_lap_times(df))
+
+        shards = self.session_shards(df, processes * self.shards_per_process)
+        with ProcessPoolExecutor(max_workers=min(processes, len(shards))) as pool:
+            results = list(pool.map(clean_and_normalize_shard, (pack_frame(df.iloc[shard]) for shard in shards)))
+
+        # Workers return the kept laps' positions within their shard, map them back to positions in df and
+        # put the laps back in df's order.
+        positions = np.concatenate([shard[kept] for shard, (_, kept) in zip(shards, results)])
+        ndf = pd.concat([unpack_frame(packed) for packed, _ in results], ignore_index=True)
+        return ndf.take(np.argsort(positions, kind='stable')).reset_index(drop=True)
+
+    def session_shards(self, df, shard_count):
+        """
+        :param df: full dataframe of lap times.
+        :param shard_count: maximum number of shards.
+        :return: list of arrays of row positions, each holding whole sessions, balanced by lap count.
+        """
+        # Laps without a session_key get a code of their own (-1 from factorize).
+        codes, sessions = pd.factorize(df['session_key'])
+        codes = np.where(codes < 0, len(sessions), codes)
+        laps_per_session = np.bincount(codes)
+        shard_count = max(1, min(shard_count, np.count_nonzero(laps_per_session)))
+
+        # Biggest sessions first, each onto the shard with the fewest laps so far.
+        shard_of_session = np.zeros(len(laps_per_session), dtype=np.intp)
+        loads = [(0, shard) for shard in range(shard_count)]
+        for session in np.argsort(-laps_per_session, kind='stable'):
+            load, shard = heapq.heappop(loads)
+            shard_of_session[session] = shard
+            heapq.heappush(loads, (load + laps_per_session[session], shard))
+
+        row_shard = shard_of_session[codes]
+        order = np.argsort(row_shard, kind='stable')
+        shards = np.split(order, np.cumsum(np.bincount(row_shard, minlength=shard_count))[:-1])
+        return [shard for shard in shards if len(shard)]
+
+    @profiled('normalize')
     def normalize_lap_times(self, df):
         """
         Function attempting to normalize lap times, accounting for fuel consumption/weight, and lap length.
@@ -83,7 +168,7 @@ class DataFormatter:
         # Similarly, if the average time for a different race is 80s and the current lap time is 90s, we get a percentage of 12.5%.
         # Now instead of seeing two identical 90s laps, we can see that the first lap is actually "faster" as a percentage difference from the average (-10% vs 12.5%).
 
-        ndfg = ndf.groupby(['session_key', 'driver_name']).agg({'normalized_lap_seconds':'mean'}).rename(columns={'normalized_lap_seconds': 'average_normalized_lap_seconds'})
+        ndfg = ndf.groupby(['session_key', 'driver_name'], observed=True).agg({'normalized_lap_seconds':'mean'}).rename(columns={'normalized_lap_seconds': 'average_normalized_lap_seconds'})
         ndf = ndf.merge(ndfg, on=['session_key', 'driver_name'])
         #Keep in mind that a smaller ratio is "faster". Also helpful to remember that the closer to 1 a ratio is, the closer to the average time it is.
         ndf['lap_time_percentage_compared_to_average'] = round(((ndf['normalized_lap_seconds'] - ndf['average_normalized_lap_seconds']) / ndf['average_normalized_lap_seconds']) * 100, 2)
@@ -91,34 +176,294 @@ class DataFormatter:
         return ndf
 
 
+    def mode_by_group(self, df, keys, col):
+        """
+        Most common value of a column within each group, without calling back into python per group.
+        Ties go to whichever value Series.value_counts would list first: the first to appear, or for
+        categoricals the first in category order.
+        :param df: df to group.
+        :param keys: list of columns to group by.
+        :param col: column to find the most common value of.
+        :return: series of the most common value of col, indexed by keys.
+        """
+        counts = df.groupby(keys + [col], observed=True, sort=False).size().reset_index(name='value_count')
+        if isinstance(counts[col].dtype, pd.CategoricalDtype):
+            counts = counts.sort_values(col, kind='stable')
+        counts = counts.sort_values('value_count', ascending=False, kind='stable')
+        return counts.drop_duplicates(keys).set_index(keys)[col].sort_index()
+
+    @profiled('stint_summary')
+    def stint_summary_df(self, full_df):
+        """
+        Function to reduce the combined df to one row per stint (per season, track & driver).
+        Every stint lies entirely within one (track_name, driver_name) pair, so summaries of different
+        drivers/tracks can be concatenated or filtered freely before being analyzed.
+        :param full_df: full combined df of laps & stints
+        :return: dataframe indexed by year, track_name, driver_name, stint_number with the stint's length, session and compound.
+        """
+        # General static tire analysis (how many times each is used, average stint length, common stints for compound), laps/times are not used or considered.
+        # Stints are kept apart per season, so the same driver's stints at a track in different years aren't merged.
+        stint_keys = ['year', 'track_name', 'driver_name', 'stint_number']
+        return pd.concat([self.mode_by_group(full_df, stint_keys, 'stint_length'),
+                          self.mode_by_group(full_df, stint_keys, 'session_key'),
+                          self.mode_by_group(full_df, stint_keys, 'compound')],
+                         axis=1)
+
     def analyze_stint_df(self, full_df):
         """
         Function to analyze stint and compound combinations and build a new df of the data.
         :param full_df: full combined df of laps & stints
         :return: dataframe grouped by stint and compound with extra analysis columns
         """
-        # General static tire analysis (how many times each is used, average stint length, common stints for compound), laps/times are not used or considered.
-        ldf = (full_df.groupby(['track_name', 'driver_name', 'stint_number'])
-               .agg({'stint_length' : (lambda x: x.value_counts().index[0]),
-                     'session_key': (lambda x: x.value_counts().index[0]),
-                     'compound' : (lambda x: x.value_counts().index[0])}))
+        return self.analyze_stint_summary(self.stint_summary_df(full_df))
 
+    @profiled('stint_analysis')
+    def analyze_stint_summary(self, ldf):
+        """
+        Function to analyze stint and compound combinations from a summary built by stint_summary_df.
+        :param ldf: stint summary df
+        :return: dataframe grouped by stint and compound with extra analysis columns
+        """
         colorMap = {'HARD': 'ghostwhite', 'MEDIUM': 'gold', 'SOFT': 'firebrick', 'INTERMEDIATE': 'seagreen', 'WET': 'royalblue'}
 
-        cdf = ldf.groupby('compound').agg({'stint_length': 'sum', 'session_key': 'count'}).rename(columns={'session_key': 'compound_stint_count', 'stint_length': 'compound_laps'})
+        cdf = ldf.groupby('compound', observed=True).agg({'stint_length': 'sum', 'session_key': 'count'}).rename(columns={'session_key': 'compound_stint_count', 'stint_length': 'compound_laps'})
         cdf['average_compound_laps'] = cdf['compound_laps'] / cdf['compound_stint_count']
         cdf['color'] = pd.Series(colorMap)
 
         sdf = ldf.groupby('stint_number').agg({'session_key':'count', 'stint_length':'mean'}).rename(columns={'session_key':'stint_count', 'stint_length':'avg_stint_length'})
-        def get_final_stint_count(x):
-            i = x.name
-            if i >= len(sdf):
-                return x['stint_count']
-            return x['stint_count'] - sdf.loc[i + 1, 'stint_count']
-        sdf['final_stint_count'] = sdf.apply(get_final_stint_count, axis=1)
+        # Stints that ended the race are the stints of this number that have no following stint.
+        # Compare against the count for the next stint number (0 past the last stint).
+        next_stint_count = sdf['stint_count'].reindex(sdf.index + 1, fill_value=0).to_numpy()
+        sdf['final_stint_count'] = sdf['stint_count'] - next_stint_count
 
 
-        scdf = ldf.groupby(['stint_number', 'compound']).agg({'stint_length': 'sum', 'session_key': 'count'}).rename(columns={'session_key': 'compound_count_per_stint', 'stint_length': 'compound_stint_laps'})
+        scdf = ldf.groupby(['stint_number', 'compound'], observed=True).agg({'stint_length': 'sum', 'session_key': 'count'}).rename(columns={'session_key': 'compound_count_per_stint', 'stint_length': 'compound_stint_laps'})
         scdf['average_compound_length_for_this_stint'] = scdf['compound_stint_laps']/scdf['compound_count_per_stint']
 
-        return scdf, cdf, sdf
\ No newline at end of file
+        return scdf, cdf, sdf
+
+    def lap_time_partials(self, lapdf):
+        """
+        Function to build partial lap time aggregates that can be combined into averages for any selection
+        of drivers/tracks without going back to the individual laps.
+        :param lapdf: normalized lap df
+        :return: dataframe indexed by track_name, driver_name, compound, stint_number with the sum and count of normalized lap times.
+        """
+        return self.lap_partials(lapdf)[0]
+
+    @profiled('lap_partials')
+    def lap_partials(self, lapdf):
+        """
+        Function to build the lap time partials and the degradation partials in a single pass over the laps:
+        one groupby per stint summing every column either needs, then the degradation partials are summed up
+        from the (much smaller) per stint sums.
+        :param lapdf: normalized lap df
+        :return: lap time partials (see lap_time_partials), degradation partials (see degradation_partials)
+        """
+        y = lapdf['normalized_lap_seconds'].to_numpy(dtype=np.float64)
+        initial_tire_age = lapdf['initial_tire_age'].to_numpy(dtype=np.float64)
+        timed = ~np.isnan(y)
+        # Laps missing a time or tire age don't count towards the degradation models, their terms are zeroed.
+        fitted = timed & ~np.isnan(initial_tire_age)
+        lap_in_stint = np.where(fitted, lapdf['lap_in_stint'].to_numpy(dtype=np.float64), 0)
+        terms = {'intercept': fitted.astype(np.float64),
+                 'lap_in_stint': lap_in_stint,
+                 'lap_in_stint_sq': lap_in_stint ** 2,
+                 'initial_tire_age': np.where(fitted, initial_tire_age, 0)}
+        y = np.where(timed, y, 0)
+
+        names = self.degradation_terms['curve']
+        sums = {'lap_seconds_sum': y, 'lap_count': timed}
+        for i, a in enumerate(names):
+            for b in names[i:]:
+                sums[f'xtx_{a}_{b}'] = terms[a] * terms[b]
+        for a in names:
+            sums[f'xty_{a}'] = terms[a] * y
+        sums['yty'] = np.where(fitted, y * y, 0)
+        # The longest stint's fitted laps bound the range the models can be evaluated over, see degradation_curve.
+        sums['max_lap_in_stint'] = lap_in_stint.astype(np.int64)
+        keys = ['track_name', 'driver_name', 'compound', 'stint_number']
+        sums.update({key: lapdf[key].array for key in keys})
+        grouped = pd.DataFrame(sums).groupby(keys, observed=True)
+        stint_sums = grouped.sum()
+        stint_sums['max_lap_in_stint'] = grouped['max_lap_in_stint'].max()
+
+        lap_time_partials = stint_sums[['lap_seconds_sum', 'lap_count']]
+        degradation = stint_sums.drop(columns=['lap_seconds_sum', 'lap_count'])
+        degradation = degradation.loc[degradation['xtx_intercept_intercept'] > 0]
+        degradation_partials = self.combine_degradation_partials(degradation, keys[:3])
+        return lap_time_partials, degradation_partials
+
+    @profiled('metric_partials')
+    def metric_partials(self, stint_summary, lap_partials):
+        """
+        Function to build the per driver/track partials of the dashboard metric cube, see metric_cube.
+        :param stint_summary: stint summary df built by stint_summary_df
+        :param lap_partials: lap time partials built by lap_time_partials
+        :return: dataframe indexed by track_name, driver_name, compound, stint_number with the stint count,
+            summed stint lengths and the sum and count of normalized lap times.
+        """
+        pdf = (stint_summary.groupby(['track_name', 'driver_name', 'compound', 'stint_number'], observed=True)
+               .agg(stint_count=('session_key', 'count'), stint_laps=('stint_length', 'sum')))
+        pdf = pdf.join(lap_partials, how='outer').fillna(0)
+        # The outer join leaves missing cells as NaN, put the counts back to ints once they're filled.
+        return pdf.astype({'stint_count': 'int64', 'stint_laps': 'int64', 'lap_count': 'int64'})
+
+    @profiled('metric_cube')
+    def metric_cube(self, partials):
+        """
+        Function to combine metric partials (any selection of metric_partials rows) into one small cube that all
+        the dashboard metrics are read from.
+        :param partials: metric partials df
+        :return: dataframe indexed by compound, stint_number with the summed partials plus average stint length
+            and average normalized lap time.
+        """
+        cube = partials.groupby(level=['compound', 'stint_number'], observed=True).sum()
+        cube['avg_stint_length'] = cube['stint_laps'] / cube['stint_count']
+        cube['avg_lap_seconds'] = cube['lap_seconds_sum'] / cube['lap_count']
+        return cube
+
+    def analyze_metric_cube(self, cube):
+        """
+        Function to roll a metric cube up into the compound vs stint, per compound and per stint views.
+        :param cube: metric cube df built by metric_cube
+        :return: compound vs stint pivot of stint counts, per compound df, per stint df
+        """
+        colorMap = {'HARD': 'ghostwhite', 'MEDIUM': 'gold', 'SOFT': 'firebrick', 'INTERMEDIATE': 'seagreen', 'WET': 'royalblue'}
+        # Cells that only exist on the lap time side have no stints.
+        cube = cube.loc[cube['stint_count'] > 0]
+
+        pivot = cube['stint_count'].unstack('compound')
+
+        cdf = cube.groupby(level='compound', observed=True)[['stint_laps', 'stint_count']].sum().rename(columns={'stint_laps': 'compound_laps', 'stint_count': 'compound_stint_count'})
+        cdf['average_compound_laps'] = cdf['compound_laps'] / cdf['compound_stint_count']
+        cdf['color'] = pd.Series(colorMap)
+
+        sdf = cube.groupby(level='stint_number')[['stint_count', 'stint_laps']].sum()
+        sdf['avg_stint_length'] = sdf.pop('stint_laps') / sdf['stint_count']
+        # Final stints only make sense per stint number, counted as in analyze_stint_summary.
+        next_stint_count = sdf['stint_count'].reindex(sdf.index + 1, fill_value=0).to_numpy()
+        sdf['final_stint_count'] = sdf['stint_count'] - next_stint_count
+
+        return pivot, cdf, sdf
+
+    def degradation_partials(self, lapdf):
+        """
+        Function to build the sufficient statistics of the tire degradation models (see fit_degradation) for every
+        driver, track and compound. Least squares only needs the sums X'X, X'y and y'y, which add up across any
+        selection of drivers/tracks, so models can be refit for a selection without going back to the laps.
+        :param lapdf: normalized lap df
+        :return: dataframe indexed by track_name, driver_name, compound with an 'xtx_{a}_{b}' column for each pair
+            of curve model terms, an 'xty_{a}' column for each term, 'yty' and 'max_lap_in_stint', the most laps
+            into a stint any fitted lap was.
+        """
+        return self.lap_partials(lapdf)[1]
+
+    def combine_degradation_partials(self, partials, levels):
+        """
+        Function to combine degradation partials over index levels: the sums add up, max_lap_in_stint is the max.
+        :param partials: degradation partials df built by degradation_partials (any selection of its rows)
+        :param levels: index levels to combine the partials per.
+        :return: dataframe indexed by levels with the columns of partials.
+        """
+        grouped = partials.groupby(level=list(levels), observed=True)
+        combined = grouped.sum()
+        combined['max_lap_in_stint'] = grouped['max_lap_in_stint'].max()
+        return combined
+
+    @profiled('degradation_fit')
+    def fit_degradation(self, partials, by=('compound', 'track_name', 'driver_name'), model='curve', within=()):
+        """
+        Function to fit tire degradation models of normalized lap time against lap_in_stint and initial_tire_age,
+        one model per group, all groups solved at once.
+        slope: lap_seconds = intercept + lap_in_stint * a + initial_tire_age * c
+        curve: lap_seconds = intercept + lap_in_stint * a + lap_in_stint^2 * b + initial_tire_age * c
+        The initial_tire_age coefficient is only meaningful for groups with stints started on differently aged tires,
+        otherwise it can't be told apart from the intercept.
+        :param partials: degradation partials df built by degradation_partials (any selection of its rows)
+        :param by: index levels of the partials to fit a model per, e.g. ('compound',) for one model per compound.
+        :param model: 'slope' or 'curve'.
+        :param within: further index levels to give their own intercept, e.g. ('track_name', 'driver_name') so one
+            model per compound isn't skewed by the differences in pace between the tracks and drivers it pools. The
+            laps are demeaned within each of these groups, so the intercept of the fit is 0.
+        :return: dataframe indexed by the by levels with a coefficient column per model term, the lap count, the
+            rmse of the fit in seconds and the max_lap_in_stint of the laps fitted.
+        """
+        names = self.degradation_terms[model]
+        sums = self.combine_degradation_partials(partials, list(by) + list(within))
+        if within:
+            # Demeaning a group's laps takes sum(x) * sum(y) / n off each of its sums, with the sums of x and y
+            # being the intercept row.
+            count = sums['xtx_intercept_intercept']
+            for i, a in enumerate(names[1:], 1):
+                for b in names[i:]:
+                    col = f'xtx_{a}_{b}' if f'xtx_{a}_{b}' in sums.columns else f'xtx_{b}_{a}'
+                    sums[col] -= sums[f'xtx_intercept_{a}'] * sums[f'xtx_intercept_{b}'] / count
+                sums[f'xty_{a}'] -= sums[f'xtx_intercept_{a}'] * sums['xty_intercept'] / count
+                sums[f'xtx_intercept_{a}'] = 0.0
+            sums['yty'] -= sums['xty_intercept'] ** 2 / count
+            sums['xty_intercept'] = 0.0
+            sums = self.combine_degradation_partials(sums, by)
+
+        def xtx(a, b):
+            return sums[f'xtx_{a}_{b}' if f'xtx_{a}_{b}' in sums.columns else f'xtx_{b}_{a}'].to_numpy()
+        # Stack every group's normal equations, (groups, terms, terms) and (groups, terms).
+        gram = np.stack([np.stack([xtx(a, b) for b in names], axis=-1) for a in names], axis=-2)
+        moments = np.stack([sums[f'xty_{a}'].to_numpy() for a in names], axis=-1)
+        # pinv rather than solve, groups with a constant term (e.g. one stint's initial_tire_age) are singular
+        # and get the minimum norm fit.
+        coefs = np.einsum('gij,gj->gi', np.linalg.pinv(gram), moments)
+
+        lap_count = sums['xtx_intercept_intercept'].to_numpy()
+        sse = sums['yty'].to_numpy() - 2 * (coefs * moments).sum(axis=1) + np.einsum('gi,gij,gj->g', coefs, gram, coefs)
+        fits = pd.DataFrame(coefs, index=sums.index, columns=names)
+        fits['lap_count'] = lap_count.astype(np.int64)
+        fits['rmse'] = np.sqrt(np.clip(sse, 0, None) / lap_count)
+        fits['max_lap_in_stint'] = sums['max_lap_in_stint']
+        return fits
+
+    def degradation_curve(self, fits, max_lap=40):
+        """
+        Function to evaluate fitted degradation models as lap time lost against the first lap of the stint.
+        :param fits: fits built by fit_degradation
+        :param max_lap: last lap_in_stint to evaluate.
+        :return: dataframe indexed by lap_in_stint with a column per fitted group of the seconds lost since lap 1,
+            NaN past the longest stint the group's model was fit on rather than extrapolated.
+        """
+        laps = np.arange(1, max_lap + 1, dtype=np.float64)
+        lost = np.outer(laps - 1, fits['lap_in_stint'].to_numpy())
+        if 'lap_in_stint_sq' in fits.columns:
+            lost += np.outer(laps ** 2 - 1, fits['lap_in_stint_sq'].to_numpy())
+        lost[laps[:, None] > fits['max_lap_in_stint'].to_numpy()] = np.nan
+        return pd.DataFrame(lost, index=pd.Index(laps.astype(int), name='lap_in_stint'), columns=fits.index)
+
+
+def pack_frame(df):
+    """
+    :return: df as an Arrow IPC buffer when pyarrow is available (columnar buffers, cheap to send to another process
+        compared to pickling the frame), otherwise df itself.
+    """
+    if pa is None:
+        return df
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def unpack_frame(packed):
+    if isinstance(packed, pd.DataFrame):
+        return packed
+    return pa.ipc.open_stream(packed).read_all().to_pandas()
+
+
+def clean_and_normalize_shard(packed):
+    """
+    Process pool entry point for DataFormatter.clean_and_normalize.
+    :return: packed normalized laps of the shard, positions within the shard of the laps kept.
+    """
+    dc = DataFormatter()
+    dfr = dc.remove_invalid_lap_times(unpack_frame(packed))
+    # remove_invalid_lap_times indexes the laps it keeps by position, normalize_lap_times keeps their order.
+    return pack_frame(dc.normalize_lap_times(dfr)), dfr.index.to_numpy()
@@ -1,93 +1,427 @@
 import json
-import requests
 import os
+import threading
+import numpy as np
 import pandas as pd
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from artifacts import cached_master_seasons
+from data_formatter import DataFormatter
+from profiling import profiled, profiler
+from response_cache import ResponseCache
+from urllib.parse import quote, urlencode, urlparse
+
+
+def set_display_options():
+    '''
+    Print whole frames, for inspecting them from scripts. Not set on import, since it changes printing for
+    everything in the process (and makes the repr of a large frame very slow).
+    '''
+    pd.set_option('display.max_rows', None)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.max_colwidth', None)
+    pd.set_option('display.width', 800)
+    pd.set_option('display.float_format', '{:,.2f}'.format)
+
+
+class ResponseTee:
+    '''
+    File-like reader over a streamed response body, so pandas can parse it as it downloads.
+    Every byte read is optionally copied to a response cache writer, which is only committed once the whole body has been read.
+    '''
+    def __init__(self, raw, tee=None):
+        self.raw = raw
+        self.tee = tee
+        self.received = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(None if size is None or size < 0 else size, decode_content=True)
+        self.received += len(data)
+        if self.tee:
+            self.tee.write(data)
+        return data
+
+    def __iter__(self):
+        # pandas checks file-likes for read and __iter__.
+        return iter(self.read, b'')
+
+    def finish(self):
+        '''
+        Drain anything the parser didn't ask for and commit the tee to the cache.
+        '''
+        while self.read(64 * 1024):
+            pass
+        if self.tee:
+            self.tee.commit()
+
+    def abort(self):
+        if self.tee:
+            self.tee.abort()
 
-pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_colwidth', None)
-pd.set_option('display.width', 800)
-pd.set_option('display.float_format', '{:,.2f}'.format)
 
 class DataUtility:
     api_url_base = 'https://api.openf1.org/v1/'
+    # Number of worker threads used when fetching per-session data, and the maximum number of
+    # requests allowed in flight against a single host at once (OpenF1 rate limits aggressive clients).
+    fetch_workers = 8
+    max_requests_per_host = 4
+    # Maximum number of processes used to build/load seasons in parallel, None uses one per cpu.
+    season_processes = None
+    # Sessions ingested less than this long after they ended are fetched again on the next refresh,
+    # the api keeps filling in lap data for a while after the chequered flag.
+    session_settle_time = timedelta(hours=2)
+    # Retry policy for the shared http session: rate limits and server errors are retried with
+    # exponential backoff (0.5s, 1s, 2s, ...) capped at max_backoff seconds.
+    max_retries = 5
+    backoff_factor = 0.5
+    max_backoff = 30
+    retry_statuses = (429, 500, 502, 503, 504)
+    request_timeout = 60
+    # csv responses are parsed this many rows at a time as they stream in. Each chunk is renamed and cast
+    # to the master schema straight away, so the raw strings of a whole session are never held at once.
+    stream_chunk_rows = 20000
+    # Copy streamed csv responses into the response cache as they are parsed. Without the tee nothing is
+    # written, and every fetch goes back to the api.
+    tee_raw_responses = True
+    # Api responses are cached under cache_root (see ResponseCache), evicting the least recently used once they
+    # take up more than cache_max_bytes. Cached responses are used without asking the api for their endpoint's
+    # ttl, and revalidated after that.
+    cache_root = 'Data/cache'
+    cache_max_bytes = 1024 ** 3
+    cache_ttls = {'sessions': timedelta(hours=1),
+                  'drivers': timedelta(days=7),
+                  'laps': timedelta(days=7),
+                  'stints': timedelta(days=7)}
+    default_cache_ttl = timedelta(days=7)
 
-    def generate_URL_and_file_path(self, api_call, params, format):
-        url = api_call + '?' + '&'.join(['&%s=%s' % (key, params[key]) for key in sorted(params.keys())])
+    # Season masters are cached as parquet (columnar, typed, column-prunable) when pyarrow is available,
+    # falling back to the old csv masters otherwise.
+    master_format = 'parquet' if pyarrow is not None else 'csv'
+    # Declared schema for the season masters. Anything missing from here is left as pandas infers it.
+    session_master_dtypes = {'session_key': 'int32',
+                             'track_name': 'category',
+                             'session_name': 'category',
+                             'driver_number': 'int16',
+                             'stint_number': 'int8',
+                             'session_country': 'category',
+                             'year': 'int16',
+                             'driver_name': 'category',
+                             'driver_short': 'category',
+                             'team_colour': 'category',
+                             'team_name': 'category',
+                             'compound': 'category',
+                             'lap_end': 'int16',
+                             'lap_start': 'int16',
+                             'stint_length': 'int16',
+                             'initial_tire_age': 'float32'}
+    lap_master_dtypes = {'meeting_key': 'int32',
+                         'session_key': 'int32',
+                         'driver_number': 'int16',
+                         'i1_speed': 'float32',
+                         'i2_speed': 'float32',
+                         'st_speed': 'float32',
+                         'lap_seconds': 'float64',
+                         'is_pit_out_lap': 'bool',
+                         'sector_1': 'float64',
+                         'sector_2': 'float64',
+                         'sector_3': 'float64',
+                         'lap_number': 'int16'}
+    master_date_columns = ['date']
+    # Columns of the merged sessions/drivers/stints api data kept in the session master, and the renames
+    # from api column names to master column names.
+    session_api_columns = ['session_key','circuit_short_name','session_name','driver_number','stint_number',
+                           'country_name','date_start','year','full_name','name_acronym','team_colour',
+                           'team_name','compound','lap_end','lap_start','stint_length','tyre_age_at_start']
+    session_api_renames = {'country_name': 'session_country',
+                           'full_name':'driver_name',
+                           'name_acronym':'driver_short',
+                           'tyre_age_at_start':'initial_tire_age',
+                           'circuit_short_name':'track_name',
+                           'date_start':'date'}
+    lap_api_renames = {'date_start': 'date',
+                       'duration_sector_1':'sector_1',
+                       'duration_sector_2':'sector_2',
+                       'duration_sector_3':'sector_3',
+                       'lap_duration':'lap_seconds',
+                       'segments_sector_1':'s1_segs',
+                       'segments_sector_2':'s2_segs',
+                       'segments_sector_3':'s3_segs'}
+    # Lap columns actually used by the analysis. The sector segment lists and meeting key are kept in the
+    # master but never loaded for analysis.
+    # Only race sessions (not sprints) run on these compounds are analyzed, see clean_df.
+    analysis_session_name = 'Race'
+    analysis_compounds = ['SOFT', 'HARD', 'MEDIUM', 'INTERMEDIATE', 'WET']
+    lap_analysis_columns = ['session_key', 'driver_number', 'i1_speed', 'i2_speed', 'st_speed', 'date', 'lap_seconds',
+                            'is_pit_out_lap', 'sector_1', 'sector_2', 'sector_3', 'lap_number']
 
-        file_path = 'Data/' + api_call
-        if not os.path.exists(file_path):
-            os.makedirs(file_path, exist_ok=True)
-        file_path += '/' + '_'.join([key[0]+'-'+params[key] for key in sorted(params.keys())]) + '_' + api_call
+    # Persistent lap store for ad hoc queries across seasons (see write_lap_store/query_laps). It's partitioned by
+    # season and track (hive style, Data/lap_store/year=2023/track_name=Sakhir/laps-{build_id}.parquet), and each
+    # partition is sorted on lap_store_sort_columns and written in small row groups, so the row group statistics
+    # index those columns: a query only opens the partitions, and reads the row groups, that can hold matching laps.
+    # Each season's year=2023/_current.json points at the build queries read, and records the masters it was built from.
+    lap_store_root = 'Data/lap_store'
+    lap_store_sort_columns = ['driver_name', 'compound', 'stint_number', 'lap_in_stint']
+    lap_store_row_group_rows = 256
 
-        if format == 'json':
-            file_path += '.json'
-        else:
-            file_path += '.csv'
-            url += '&csv=true'
-        return url, file_path
+    def __init__(self, fetch_workers=None, max_requests_per_host=None):
+        if fetch_workers is not None:
+            self.fetch_workers = fetch_workers
+        if max_requests_per_host is not None:
+            self.max_requests_per_host = max_requests_per_host
+        self._host_limits = {}
+        self._host_limits_lock = threading.Lock()
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._response_caches = {}
+        self._response_caches_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_request_stats()
+
+    @property
+    def session(self):
+        '''
+        :return: the shared http session, built on first use so the network stack is only imported once a
+            request actually has to be made (not when everything is served from cache or artifacts).
+        '''
+        with self._session_lock:
+            if self._session is None:
+                self._session = self.build_session()
+            return self._session
+
+    def build_session(self):
+        '''
+        :return: a requests session with keep-alive connection pooling and retry/backoff on transient errors.
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=self.max_retries,
+                      backoff_factor=self.backoff_factor,
+                      backoff_max=self.max_backoff,
+                      status_forcelist=self.retry_statuses,
+                      allowed_methods=['GET'],
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        # The pool only needs to be as large as the number of requests we let through to a host at once.
+        adapter = HTTPAdapter(pool_connections=self.max_requests_per_host,
+                              pool_maxsize=self.max_requests_per_host,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reset_request_stats(self):
+        with self._stats_lock:
+            self.stats = {'requests': 0, 'bytes': 0, 'cache_hits': 0, 'not_modified': 0}
+
+    def request_stats(self):
+        '''
+        :return: copy of the transfer counters: http requests made, payload bytes downloaded,
+        cache hits (cached response used without a request) and not_modified (stale response revalidated by a 304).
+        '''
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def count_stat(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def host_limit(self, call_url):
+        '''
+        :param call_url: full url about to be requested.
+        :return: semaphore bounding the number of concurrent requests to the url's host.
+        '''
+        host = urlparse(call_url).netloc
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_requests_per_host)
+            return self._host_limits[host]
+
+    @property
+    def response_cache(self):
+        '''
+        :return: the response cache under cache_root, relative to the current working directory like the rest of Data/.
+        '''
+        root = os.path.abspath(self.cache_root)
+        with self._response_caches_lock:
+            if root not in self._response_caches:
+                self._response_caches[root] = ResponseCache(root, self.cache_max_bytes)
+            return self._response_caches[root]
+
+    def generate_URL(self, api_call, params, format):
+        '''
+        :return: normalized url of the request: parameters sorted and encoded, so the same request is always
+            the same response cache key.
+        '''
+        query = sorted(params.items())
+        if format == 'csv':
+            query.append(('csv', 'true'))
+        elif format != 'json':
+            raise ValueError(f'Invalid request format specified : {format}')
+        return self.api_url_base + api_call + '?' + urlencode(query)
+
+    def cache_ttl(self, api_call):
+        return self.cache_ttls.get(api_call, self.default_cache_ttl).total_seconds()
+
+    def cached_response(self, call_url, cache):
+        '''
+        :param call_url: normalized url.
+        :param cache: if False, cached responses are ignored.
+        :return: cache entry for the url (see ResponseCache.lookup), or None.
+        '''
+        if not cache:
+            return None
+        # The body can still be evicted by another process after the lookup, readers handle FileNotFoundError.
+        return self.response_cache.lookup(call_url)
 
     def request(self, api_call, params, format, cache=True):
-        #Get the url to be called and the file path to be written for this request.
-        call_url, file_path = self.generate_URL_and_file_path(api_call, params, format=format)
+        '''
+        Request an endpoint, through the response cache.
+        :param cache: if False, ignore any cached response and request the data again.
+        :return: the parsed json for json requests, the csv text for csv requests.
+        '''
+        call_url = self.generate_URL(api_call, params, format=format)
+        entry = self.cached_response(call_url, cache)
+        if entry is not None and entry['fresh']:
+            try:
+                response = self.read_cached_body(entry['path'], format)
+                self.count_stat('cache_hits')
+                return response
+            except FileNotFoundError:
+                # Evicted by another process since the lookup.
+                entry = None
 
-        #json files are not automatically written to disk
-        #caching will cause json files to be saved and/or referenced.
+        with self.host_limit(call_url), \
+                self.http_get(call_url, entry) as r:
+            if r.status_code != 304:
+                self.count_stat('bytes', len(r.content))
+                self.response_cache.store(call_url, r.content, self.cache_ttl(api_call),
+                                          r.headers.get('ETag'), r.headers.get('Last-Modified'))
+                return r.json() if format == 'json' else r.text
+        try:
+            return self.read_cached_body(entry['path'], format)
+        except FileNotFoundError:
+            # Evicted by another process before the server confirmed it, ask for it in full.
+            return self.request(api_call, params, format, cache=False)
+
+    def read_cached_body(self, path, format):
         if format == 'json':
-            if not cache:
-                #We're not caching, always request a new file.
-                resp = self.request_json(self.api_url_base + call_url)
-            elif not os.path.exists(file_path):
-                #File doesn't exist yet, request and store it.
-                resp = self.request_json(self.api_url_base + call_url)
-                self.write_json_file(file_path, resp)
-            else:
-                #File exists, check if we need to refresh it
-                if self.file_should_refresh(file_path):
-                    resp = self.request_json(self.api_url_base + call_url)
-                    self.write_json_file(file_path, resp)
-                else:
-                    resp = self.read_json_file(file_path)
-            return resp
-        #csv files are written to disk automatically as part of the request.
-        #caching only changes whether we care about existing files.
-        elif format == 'csv':
-            if not cache:
-                #We're not caching, ignore any local files
-                self.request_csv(self.api_url_base + call_url, file_path)
-            elif not os.path.exists(file_path):
-                #File doesn't exist yet, request it.
-                self.request_csv(self.api_url_base + call_url, file_path)
-            else:
-                #File exists, check if it needs a refresh.
-                if self.file_should_refresh(file_path):
-                    self.request_csv(self.api_url_base + call_url, file_path)
-            return file_path
-        else:
-            #invalid format specified.
-            raise ValueError(f'Invalid request format specified : {format}')
+            return self.read_json_file(path)
+        with open(path, 'r') as f:
+            return f.read()
+
+    def conditional_headers(self, entry):
+        '''
+        :param entry: cache entry about to be revalidated.
+        :return: If-None-Match/If-Modified-Since headers from the validators stored with the entry, if any.
+        '''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
 
-    def file_should_refresh(self, file_path):
-        current_datetime = datetime.now()
-        file_modified_datetime = datetime.fromtimestamp(os.path.getmtime(file_path))
-        if current_datetime - timedelta(days=7) > file_modified_datetime:
-            print("retrieving new file:\n\t" + file_path)
-            return True
+    def http_get(self, call_url, entry=None, stream=False):
+        '''
+        Issue a GET through the shared session.
+        :param call_url: full normalized url to request.
+        :param entry: if given, the request is made conditional on the validators stored with this cache entry.
+        :param stream: stream the response body rather than reading it up front.
+        :return: the response. A 304 status means the cached entry is still current.
+        '''
+        headers = self.conditional_headers(entry) if entry else {}
+        r = self.session.get(call_url, headers=headers, stream=stream, timeout=self.request_timeout)
+        self.count_stat('requests')
+        if r.status_code == 304:
+            self.count_stat('not_modified')
+            # Restart the entry's ttl, it is known to be current.
+            self.response_cache.touch(call_url)
         else:
-            print("Using existing file:\n\t" + file_path)
-            return False
+            r.raise_for_status()
+        return r
 
-    def request_csv(self, call_url, file_path):
-        with open(file_path, 'wb') as f, \
-                requests.get(call_url, stream=True) as r:
-            for line in r.iter_lines():
-                f.write(line + '\n'.encode())
+    def request_df(self, api_call, params, cache=True, renames=None, dtypes=None, store=True):
+        '''
+        Request an endpoint as csv and parse it straight into a typed dataframe while it downloads.
+        A fresh cached response is parsed instead of making a request, and a stale one is revalidated.
+        :param api_call: endpoint name, e.g. 'laps'.
+        :param params: query parameters.
+        :param cache: if False, ignore any cached response and request the data again.
+        :param renames: api column name -> master column name renames applied to each chunk.
+        :param dtypes: master schema (renamed column names) the chunks are cast to.
+        :param store: if False, the response isn't written to the response cache (e.g. polls of a live session,
+            which are stale by the next poll).
+        :return: the parsed frame, empty if the api had no data.
+        '''
+        call_url = self.generate_URL(api_call, params, format='csv')
+        entry = self.cached_response(call_url, cache)
+        if entry is not None and entry['fresh']:
+            try:
+                df = self.read_csv_chunks(entry['path'], renames, dtypes)
+                self.count_stat('cache_hits')
+                return df
+            except FileNotFoundError:
+                # Evicted by another process since the lookup.
+                entry = None
+
+        with self.host_limit(call_url), \
+                self.http_get(call_url, entry, stream=True) as r:
+            if r.status_code != 304:
+                tee = None
+                if self.tee_raw_responses and store:
+                    tee = self.response_cache.writer(call_url, self.cache_ttl(api_call),
+                                                     r.headers.get('ETag'), r.headers.get('Last-Modified'))
+                body = ResponseTee(r.raw, tee)
+                try:
+                    df = self.read_csv_chunks(body, renames, dtypes)
+                    if len(df):
+                        body.finish()
+                    else:
+                        # Not cached: a session with no data yet is asked for again, rather than served empty for its ttl.
+                        body.abort()
+                except BaseException:
+                    body.abort()
+                    raise
+                self.count_stat('bytes', body.received)
+                return df
+        try:
+            return self.read_csv_chunks(entry['path'], renames, dtypes)
+        except FileNotFoundError:
+            # Evicted by another process before the server confirmed it, ask for it in full.
+            return self.request_df(api_call, params, cache=False, renames=renames, dtypes=dtypes, store=store)
 
-    def request_json(self, call_url):
-        with requests.get(call_url) as r:
-            request_json = r.json()
-        return request_json
+    @profiled('parse')
+    def read_csv_chunks(self, source, renames=None, dtypes=None):
+        '''
+        Parse csv data in chunks of stream_chunk_rows rows, renaming and typing each chunk as it is parsed.
+        Categorical columns are only cast once all chunks are joined, so every chunk shares the same categories.
+        :param source: file path or file-like object (e.g. a ResponseTee).
+        :return: the parsed frame, empty if the source was empty.
+        '''
+        dtypes = dtypes or {}
+        chunk_dtypes = {col: dtype for col, dtype in dtypes.items() if dtype != 'category'}
+        chunks = []
+        try:
+            with pd.read_csv(source, chunksize=self.stream_chunk_rows) as reader:
+                for chunk in reader:
+                    if renames:
+                        chunk.rename(columns=renames, inplace=True)
+                    chunks.append(self.apply_master_schema(chunk, chunk_dtypes, copy=False))
+        except pd.errors.EmptyDataError:
+            # Sessions that haven't produced any data yet come back empty.
+            return pd.DataFrame()
+        df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+        categories = {col: 'category' for col, dtype in dtypes.items() if dtype == 'category' and col in df.columns}
+        return df.astype(categories) if categories else df
 
     def write_json_file(self, file_path, python_object):
         with open(file_path, 'w') as f:
@@ -98,17 +432,17 @@ class DataUtility:
             json_object = json.load(openfile)
         return json_object
 
-    def request_sessions(self, params, format='json'):
-        return self.request('sessions', params, format=format)
+    def request_sessions(self, params, format='json', cache=True):
+        return self.request('sessions', params, format=format, cache=cache)
 
-    def request_drivers(self, params, format='json'):
-        return self.request('drivers', params, format=format, cache=True)
+    def request_drivers(self, params, format='json', cache=True):
+        return self.request('drivers', params, format=format, cache=cache)
 
-    def request_laps(self, params, format='json'):
-        return self.request('laps', params, format=format, cache=True)
+    def request_laps(self, params, format='json', cache=True):
+        return self.request('laps', params, format=format, cache=cache)
 
-    def request_stints(self, params, format='json'):
-        return self.request('stints', params, format=format, cache=True)
+    def request_stints(self, params, format='json', cache=True):
+        return self.request('stints', params, format=format, cache=cache)
 
     def get_driver_params(self, name_acronym='', driver_number=-1, year=0, session_name='', circuit=''):
         params = {}
@@ -130,113 +464,618 @@ class DataUtility:
 
         return params
 
+    def plan_requests(self, queries):
+        '''
+        Resolve driver queries to the sessions they cover, so they can be answered by session level requests.
+        Each query's year, session_name and circuit_short_name are matched against the season's session list
+        (one cached request per season, however many queries there are).
+        :param queries: list of parameter dicts, as built by get_driver_params. A 'session_key' may also be given.
+        :return: list of the session keys each query covers, in query order. None for queries that can't be
+            resolved to sessions (no year or session_key), which have to be requested as they are.
+        '''
+        years = sorted({q['year'] for q in queries if 'session_key' not in q and 'year' in q})
+        sessiondfs = {year: self.request_df('sessions', {'year': year}) for year in years}
+        planned = []
+        for query in queries:
+            if 'session_key' in query:
+                planned.append([int(query['session_key'])])
+                continue
+            if 'year' not in query:
+                planned.append(None)
+                continue
+            sessiondf = sessiondfs[query['year']]
+            if not len(sessiondf):
+                planned.append([])
+                continue
+            mask = np.ones(len(sessiondf), dtype=bool)
+            for param in ('session_name', 'circuit_short_name'):
+                if param in query:
+                    mask &= sessiondf[param].astype(str).to_numpy() == query[param]
+            planned.append(sessiondf.loc[mask, 'session_key'].astype(int).tolist())
+        return planned
+
+    @profiled('fetch')
+    def request_many(self, api_call, queries, cache=True):
+        '''
+        Request an endpoint for many driver queries at once, e.g. the laps of several drivers at several circuits.
+        Rather than a request per query, there's one per session the queries cover (see plan_requests), made
+        concurrently, and each query's rows are split out locally. These are the same requests fetch_session_data
+        makes, so sessions already in the response cache aren't requested again, and queries covering the same
+        session share its request.
+        :param api_call: 'laps', 'stints' or 'drivers'.
+        :param queries: list of parameter dicts, as built by get_driver_params.
+        :param cache: if False, ignore cached responses and request the data again.
+        :return: list of dfs (api column names) with the rows each query would have got on its own, in query order.
+        '''
+        planned = self.plan_requests(queries)
+        session_keys = sorted({key for keys in planned if keys is not None for key in keys})
+        # Laps and stints only carry driver numbers, acronyms are looked up in the session's drivers.
+        by_acronym = api_call != 'drivers' and any('name_acronym' in q for q in queries)
+        # Queries that can't be planned are requested as they are, once per distinct set of parameters.
+        direct = list(dict.fromkeys(tuple(sorted(q.items())) for q, keys in zip(queries, planned) if keys is None))
+
+        calls = [(api_call, {'session_key': str(key)}) for key in session_keys]
+        if by_acronym:
+            calls += [('drivers', {'session_key': str(key)}) for key in session_keys]
+        calls += [(api_call, dict(params)) for params in direct]
+        with ThreadPoolExecutor(max_workers=max(1, self.fetch_workers)) as pool:
+            results = iter(list(pool.map(lambda call: self.request_df(*call, cache=cache), calls)))
+        session_frames = {key: next(results) for key in session_keys}
+        driver_frames = {key: next(results) for key in session_keys} if by_acronym else {}
+        direct_frames = {params: next(results) for params in direct}
+
+        frames = []
+        for query, keys in zip(queries, planned):
+            if keys is None:
+                frames.append(direct_frames[tuple(sorted(query.items()))])
+                continue
+            parts = []
+            for key in keys:
+                df = session_frames[key]
+                if not len(df):
+                    continue
+                if 'name_acronym' in query and api_call == 'drivers':
+                    mask = df['name_acronym'] == query['name_acronym']
+                elif 'name_acronym' in query:
+                    drivers = driver_frames[key]
+                    numbers = drivers.loc[drivers['name_acronym'] == query['name_acronym'], 'driver_number'] if len(drivers) else []
+                    mask = df['driver_number'].isin(numbers)
+                elif 'driver_number' in query:
+                    mask = df['driver_number'].astype(str) == query['driver_number']
+                else:
+                    mask = np.ones(len(df), dtype=bool)
+                parts.append(df.loc[mask])
+            frames.append(pd.concat(parts, ignore_index=True) if parts else pd.DataFrame())
+        return frames
+
+    @profiled('clean')
     def clean_df(self, df):
         # remove stints/laps where the tire compound is marked as "unknown"
-        df = df.loc[df['compound'].isin(['SOFT', 'HARD', 'MEDIUM', 'INTERMEDIATE', 'WET'])]
+        df = df.loc[df['compound'].isin(self.analysis_compounds)]
         # remove sprint sessions.
-        df = df.loc[df['session_name'] == 'Race']
+        df = df.loc[df['session_name'] == self.analysis_session_name]
         return df
 
+    def analysis_session_filters(self):
+        '''
+        :return: clean_df's conditions as parquet read filters, so they can be applied while reading the session master.
+        '''
+        return [('session_name', '==', self.analysis_session_name), ('compound', 'in', self.analysis_compounds)]
+
+    @profiled('explode')
+    def expand_stints_to_laps(self, sessiondf):
+        '''
+        Expand each stint row into one row per lap it covers.
+        :param sessiondf: session master, one row per session/driver/stint.
+        :return: new df with a row for each lap of each stint, plus 'lap_number' and 'lap_in_stint' columns.
+        '''
+        lap_start = sessiondf['lap_start'].to_numpy()
+        # Stints where lap_end comes before lap_start cover no laps and are dropped.
+        stint_laps = np.clip(sessiondf['lap_end'].to_numpy() - lap_start + 1, 0, None)
+        rows = np.repeat(np.arange(len(sessiondf)), stint_laps)
+        # Position of each lap within its stint: its overall position minus where its stint's block starts.
+        lap_offset = np.arange(len(rows)) - np.repeat(np.cumsum(stint_laps) - stint_laps, stint_laps)
+
+        expanded = sessiondf.iloc[rows].reset_index(drop=True)
+        expanded['lap_number'] = (lap_start[rows] + lap_offset).astype(lap_start.dtype)
+        expanded['lap_in_stint'] = (lap_offset + 1).astype(lap_start.dtype)
+        return expanded
+
     def combine_laps_and_session(self, lapdf, sessiondf):
-        def generate_laps_list(start, end):
-            if start == end:
-                return [start]
-            return [i for i in range(start, end+1)]
-        sessiondf['lap_number'] = sessiondf.apply(lambda x: generate_laps_list(x.lap_start, x.lap_end), axis=1)
-        sessiondf = sessiondf.explode('lap_number', ignore_index=True)
-        sessiondf['lap_in_stint'] = sessiondf['lap_number'] - sessiondf['lap_start'] + 1
+        # clean_df only looks at session columns, so it's applied to the stints before they're expanded and joined
+        # with the laps rather than to the joined frame. The inner join keeps the same rows in the same order either way.
+        stint_laps = self.expand_stints_to_laps(self.clean_df(sessiondf))
+        with profiler.stage('merge', lapdf) as stage:
+            return stage.done(lapdf.merge(stint_laps, on=['session_key', 'driver_number', 'lap_number']))
 
-        fulldf = lapdf.merge(sessiondf, on=['session_key', 'driver_number', 'lap_number'])
-        return self.clean_df(fulldf)
+    @profiled('fetch')
+    def fetch_session_data(self, session_keys, cache=True):
+        '''
+        Fetch the laps, drivers and stints for every session concurrently.
+        :param session_keys: iterable of session keys to fetch.
+        :param cache: if False, ignore any cached files for these sessions and request them again.
+        :return: lap_list, driver_list, stint_list of dataframes, in the same order as session_keys.
+            Laps come back with master column names and types.
+        '''
+        session_keys = list(session_keys)
+
+        def fetch(sesh):
+            key_params = {'session_key': str(sesh)}
+            # Laps are renamed and typed to the master schema as they stream in.
+            t_l_df = self.request_df('laps', key_params, cache=cache,
+                                     renames=self.lap_api_renames, dtypes=self.lap_master_dtypes)
+            t_d_df = self.request_df('drivers', key_params, cache=cache)
+            t_s_df = self.request_df('stints', key_params, cache=cache)
+            # Single print per session so output from concurrent workers doesn't interleave.
+            print(f'\t{str(sesh)} laps, drivers & stints retrieved:\n'
+                  f'\t\t{len(t_l_df)} laps retrieved.\n'
+                  f'\t\t{len(t_d_df)} drivers retrieved.\n'
+                  f'\t\t{len(t_s_df)} stints retrieved.')
+            return t_l_df, t_d_df, t_s_df
 
-    def get_all_laps_and_sessions_per_year_df(self, year):
+        # Each session's requests are independent, so we fetch them all at once and let host_limit
+        # throttle how many actually hit the API simultaneously. map() keeps the original session order,
+        # so the concatenated frames come out exactly as the sequential loop produced them.
+        with ThreadPoolExecutor(max_workers=max(1, self.fetch_workers)) as pool:
+            results = list(pool.map(fetch, session_keys))
+
+        lap_list = [r[0] for r in results]
+        driver_list = [r[1] for r in results]
+        stint_list = [r[2] for r in results]
+        return lap_list, driver_list, stint_list
+
+    def master_path(self, year, kind, format=None):
         '''
-        :param year: the year we're interested in.
-        :return: lapdf of all laps for races and sprints for the given year, sessiondf containing all metadata for all sessions (race/sprints)
+        :param year: season of the master.
+        :param kind: 'laps' or 'session'.
+        :param format: 'parquet' or 'csv', defaults to master_format.
+        :return: path of the cached season master.
         '''
+        format = format or self.master_format
+        return f'Data/{year}_{kind}_master.{format}'
 
-        cached_laps_path = f'Data/' + str(year) + '_laps_master.csv'
-        cached_session_path = f'Data/' + str(year) + '_session_master.csv'
-        if os.path.exists(cached_laps_path) and os.path.exists(cached_session_path):
-            return self.combine_laps_and_session(pd.read_csv(cached_laps_path), pd.read_csv(cached_session_path))
-
-        #This is a sort of odd request (no params); manually constructing it rather than going through existing methods
-        print('Getting stints')
-        stint_url = 'stints?&csv=true'
-        file_path = 'Data/stints'
-        if not os.path.exists(file_path):
-            os.makedirs(file_path, exist_ok=True)
-        file_path += f'/{year}_stints.csv'
-        # File exists, check if it needs a refresh.
-        if not os.path.exists(file_path):
-            self.request_csv(self.api_url_base + stint_url, file_path)
-        stintdf = pd.read_csv(file_path)
-        print(f'{len(stintdf)} stints retrieved.')
-        print('...\nGetting sessions')
-        #Get all sessions for a given year.
-        sessiondf = pd.read_csv(self.request_sessions({'year':str(year)}, format='csv'))
-        print(f'{len(sessiondf)} sessions retrieved.')
-        #filter by "Race" events (includes Sprints)
-        sessiondf = sessiondf[sessiondf['session_type'] == 'Race']
-        print(f'Filtered down to {len(sessiondf)} race and sprint sessions')
-        print(sessiondf)
+    def apply_master_schema(self, df, dtypes, copy=True):
+        '''
+        Cast a master frame to the declared schema: categoricals, small ints and parsed utc timestamps.
+        :param df: session or lap master as read from the api or an old csv master.
+        :param dtypes: session_master_dtypes or lap_master_dtypes.
+        :param copy: if False, the date and pit out columns are converted in place on df.
+        :return: the typed frame.
+        '''
+        if copy:
+            df = df.copy()
+        for col in self.master_date_columns:
+            if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(df[col], utc=True, format='ISO8601')
+        if 'is_pit_out_lap' in df.columns:
+            # Missing flags behave like False everywhere we use them (we only ever drop laps that are True).
+            df['is_pit_out_lap'] = df['is_pit_out_lap'].fillna(False)
+        return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+
+    def write_master(self, df, path):
+        if path.endswith('.parquet'):
+            df.to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
 
+    @profiled('parse')
+    def read_master(self, path, dtypes, columns=None, filters=None):
+        '''
+        :param path: path of a parquet or csv season master.
+        :param dtypes: schema to apply to csv masters (parquet masters already carry it).
+        :param columns: only load these columns.
+        :param filters: only load rows matching all of these (column, '==' or 'in', value) conditions. Parquet masters
+            apply them while reading, skipping row groups that can't match.
+        :return: the typed master frame.
+        '''
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path, columns=columns, filters=filters)
+        df = self.apply_master_schema(pd.read_csv(path, usecols=columns), dtypes)
+        for col, op, value in filters or []:
+            df = df.loc[df[col] == value] if op == '==' else df.loc[df[col].isin(value)]
+        return df
 
-        lap_list = []
-        driver_list = []
-        print('Building driver and lap lists:')
-        i = 1
-        for sesh in sessiondf['session_key']:
-            print(f'{i}/{len(sessiondf)} session ({sesh}):')
-            i+=1
-            key_params = {'session_key': str(sesh)}
-            t_l_df = pd.read_csv(self.request_laps(key_params, format='csv'))
-            t_d_df = pd.read_csv(self.request_drivers(key_params, format='csv'))
-            print(f'\t{str(sesh)} laps & drivers retrieved:')
-            print(f'\t\t{len(t_l_df)} laps retrieved.')
-            print(f'\t\t{len(t_d_df)} drivers retrieved.')
-            lap_list.append(t_l_df)
-            driver_list.append(t_d_df)
+    def migrate_csv_masters(self, year):
+        '''
+        One shot conversion of the old csv season masters to the typed columnar format.
+        The csv files are left in place.
+        :param year: season to migrate.
+        :return: True if the masters were migrated.
+        '''
+        if self.master_format == 'csv':
+            return False
+        migrated = False
+        for kind, dtypes in (('session', self.session_master_dtypes), ('laps', self.lap_master_dtypes)):
+            csv_path = self.master_path(year, kind, format='csv')
+            if os.path.exists(csv_path) and not os.path.exists(self.master_path(year, kind)):
+                print(f'Migrating {csv_path} to {self.master_format}')
+                self.write_master(self.apply_master_schema(pd.read_csv(csv_path), dtypes), self.master_path(year, kind))
+                migrated = True
+        return migrated
+
+    def cached_seasons(self):
+        '''
+        :return: sorted list of seasons that have both season masters cached, in either format.
+        '''
+        return cached_master_seasons()
+
+    def load_masters(self, year, analysis_only=False):
+        '''
+        :param year: season to load.
+        :param analysis_only: only load the stints clean_df keeps and the laps of their sessions, filtering while reading.
+        :return: lapdf (analysis columns only), sessiondf for the year, or None if the masters aren't cached.
+        '''
+        self.migrate_csv_masters(year)
+        cached_laps_path = self.master_path(year, 'laps')
+        cached_session_path = self.master_path(year, 'session')
+        if not (os.path.exists(cached_laps_path) and os.path.exists(cached_session_path)):
+            return None
+        if not analysis_only:
+            lapdf = self.read_master(cached_laps_path, self.lap_master_dtypes, columns=self.lap_analysis_columns)
+            sessiondf = self.read_master(cached_session_path, self.session_master_dtypes)
+            return lapdf, sessiondf
+        sessiondf = self.read_master(cached_session_path, self.session_master_dtypes, filters=self.analysis_session_filters())
+        session_keys = sessiondf['session_key'].unique().tolist()
+        lapdf = self.read_master(cached_laps_path, self.lap_master_dtypes, columns=self.lap_analysis_columns,
+                                 filters=[('session_key', 'in', session_keys)])
+        return lapdf, sessiondf
+
+    def manifest_path(self, year):
+        return f'Data/{year}_manifest.json'
+
+    def read_manifest(self, year):
+        '''
+        :param year: season of the manifest.
+        :return: {session_key: {'date_end':..., 'ingested_at':...}} of the sessions already in the season masters.
+        '''
+        if os.path.exists(self.manifest_path(year)):
+            return {int(k): v for k, v in self.read_json_file(self.manifest_path(year)).items()}
+        # Masters built before manifests existed: everything in them was ingested when the master was written.
+        session_path = self.master_path(year, 'session')
+        if not os.path.exists(session_path):
+            return {}
+        ingested_at = datetime.fromtimestamp(os.path.getmtime(session_path)).astimezone().isoformat()
+        session_keys = self.read_master(session_path, self.session_master_dtypes, columns=['session_key'])['session_key']
+        return {int(k): {'date_end': None, 'ingested_at': ingested_at} for k in session_keys.unique()}
+
+    def stale_sessions(self, sessiondf, manifest):
+        '''
+        :param sessiondf: the season's race sessions, as listed by the sessions endpoint.
+        :param manifest: manifest of sessions already ingested.
+        :return: list of session keys that are new, or have changed since they were ingested.
+        '''
+        stale = []
+        for session_key, date_end in zip(sessiondf['session_key'], sessiondf['date_end']):
+            date_end = date_end if isinstance(date_end, str) else None
+            entry = manifest.get(int(session_key))
+            if entry is None:
+                stale.append(session_key)
+            elif entry['date_end'] is not None and entry['date_end'] != date_end:
+                # The session was moved or its end changed (red flags, suspension...).
+                stale.append(session_key)
+            elif date_end is not None and pd.Timestamp(entry['ingested_at']) < pd.Timestamp(date_end) + self.session_settle_time:
+                # Ingested while running or just after, the api may still have been filling in its data.
+                stale.append(session_key)
+        return stale
+
+    def build_master_rows(self, sessiondf, cache=True):
+        '''
+        Fetch and build the season master rows for the given sessions.
+        :param sessiondf: race sessions to build, as listed by the sessions endpoint.
+        :param cache: if False, ignore any cached per-session files.
+        :return: lapdf, sessiondf master rows for the sessions, typed to the master schema. Sessions the api has no
+            laps, drivers or stints for yet (e.g. a race that has only just started) are left out.
+        '''
+        print('Building driver, lap and stint lists:')
+        lap_list, driver_list, stint_list = self.fetch_session_data(sessiondf['session_key'], cache=cache)
+        complete = [i for i, frames in enumerate(zip(lap_list, driver_list, stint_list)) if all(len(df) for df in frames)]
+        if len(complete) < len(lap_list):
+            print(f'{len(lap_list) - len(complete)} sessions have no laps, drivers or stints yet, skipping them.')
+        if not complete:
+            return self.empty_masters()
+        sessiondf = sessiondf.iloc[complete]
+        lap_list, driver_list, stint_list = ([frames[i] for i in complete] for frames in (lap_list, driver_list, stint_list))
         lapdf = pd.concat(lap_list, ignore_index=True)
         driverdf = pd.concat(driver_list, ignore_index=True)
+        stintdf = pd.concat(stint_list, ignore_index=True)
         print(f'{len(lapdf)} total laps retrieved')
         print(f'{len(driverdf)} total driver records retrieved')
+        print(f'{len(stintdf)} total stints retrieved')
 
         #build the final sessiondf:
         sessiondf = pd.merge(sessiondf, driverdf, on=['session_key'])
         sessiondf = pd.merge(sessiondf, stintdf, on=['session_key', 'driver_number'])
         print(f'{len(sessiondf)} total session records (should be 1 for every driver, stint, session combo)')
 
+        sessiondf['stint_length'] = sessiondf['lap_end'] - sessiondf['lap_start'] + 1
+        sessiondf = sessiondf[self.session_api_columns].rename(columns=self.session_api_renames)
+
+        return (self.apply_master_schema(lapdf, self.lap_master_dtypes),
+                self.apply_master_schema(sessiondf, self.session_master_dtypes))
+
+    def refresh_season_masters(self, year):
+        '''
+        Bring the season masters up to date, only fetching sessions that are new or changed since they were ingested.
+        Building a season from scratch is the same as refreshing it with nothing ingested.
+        :param year: season to refresh.
+        :return: lapdf (analysis columns only), sessiondf for the year.
+        '''
+        self.migrate_csv_masters(year)
+        print('Getting sessions')
+        #Get all sessions for a given year. Always ask the api, this is how we find out about new sessions.
+        sessiondf = self.request_df('sessions', {'year':str(year)}, cache=False)
+        print(f'{len(sessiondf)} sessions retrieved.')
+        #filter by "Race" events (includes Sprints) that have started.
+        sessiondf = sessiondf[(sessiondf['session_type'] == 'Race') &
+                              (pd.to_datetime(sessiondf['date_start'], utc=True, format='ISO8601') <= pd.Timestamp.now(tz='UTC'))]
+        print(f'Filtered down to {len(sessiondf)} race and sprint sessions')
+
+        cached_laps_path = self.master_path(year, 'laps')
+        cached_session_path = self.master_path(year, 'session')
+        have_masters = os.path.exists(cached_laps_path) and os.path.exists(cached_session_path)
+        # Without masters the manifest describes sessions we no longer have, so every session is rebuilt.
+        manifest = self.read_manifest(year) if have_masters else {}
+        stale = self.stale_sessions(sessiondf, manifest)
+        print(f'{len(stale)} new or changed sessions to fetch.')
+        if not stale and have_masters:
+            return self.load_masters(year)
+
+        # Sessions we've already ingested are refetched, ignoring the cached per-session files.
+        new_keys = [k for k in stale if int(k) not in manifest]
+        changed_keys = [k for k in stale if int(k) in manifest]
+        built = [self.build_master_rows(sessiondf[sessiondf['session_key'].isin(keys)], cache=cache)
+                 for keys, cache in ((new_keys, True), (changed_keys, False)) if keys]
+        built = [b for b in built if len(b[1])]
+        if not built:
+            # No race has started yet this season, or the api has no data for the ones that just did.
+            print(f'No new race data found for {year}.')
+            return self.load_masters(year) if have_masters else self.empty_masters()
+        new_lapdf = pd.concat([b[0] for b in built], ignore_index=True)
+        new_sessiondf = pd.concat([b[1] for b in built], ignore_index=True)
+        # Sessions skipped for having no data yet keep their old rows, and stay out of the manifest so the next
+        # refresh asks for them again.
+        built_keys = set(new_sessiondf['session_key'].unique())
+
+        if have_masters:
+            # Replace any rows of the refetched sessions and append the rest.
+            old_lapdf = self.read_master(cached_laps_path, self.lap_master_dtypes)
+            old_sessiondf = self.read_master(cached_session_path, self.session_master_dtypes)
+            new_lapdf = pd.concat([old_lapdf[~old_lapdf['session_key'].isin(built_keys)], new_lapdf], ignore_index=True)
+            new_sessiondf = pd.concat([old_sessiondf[~old_sessiondf['session_key'].isin(built_keys)], new_sessiondf], ignore_index=True)
+
         print('caching built dfs.')
+        lapdf = self.apply_master_schema(new_lapdf, self.lap_master_dtypes)
+        sessiondf_master = self.apply_master_schema(new_sessiondf, self.session_master_dtypes)
+        self.write_master(sessiondf_master, cached_session_path)
+        self.write_master(lapdf, cached_laps_path)
 
-        sessiondf['stint_length'] = sessiondf['lap_end'] - sessiondf['lap_start'] + 1
-        sessiondf = sessiondf[['session_key','circuit_short_name','session_name','driver_number','stint_number',
-                               'country_name','date_start','year','full_name','name_acronym','team_colour',
-                               'team_name','compound','lap_end','lap_start','stint_length','tyre_age_at_start']]
+        ingested_at = datetime.now().astimezone().isoformat()
+        for session_key, date_end in zip(sessiondf['session_key'], sessiondf['date_end']):
+            if session_key in built_keys:
+                manifest[int(session_key)] = {'date_end': date_end if isinstance(date_end, str) else None,
+                                              'ingested_at': ingested_at}
+        self.write_json_file(self.manifest_path(year), {str(k): v for k, v in manifest.items()})
+
+        return lapdf[self.lap_analysis_columns], sessiondf_master
+
+    def empty_masters(self):
+        '''
+        :return: lapdf (analysis columns only), sessiondf with the master columns and types but no rows.
+        '''
+        session_columns = [self.session_api_renames.get(col, col) for col in self.session_api_columns]
+        return (self.apply_master_schema(pd.DataFrame(columns=self.lap_analysis_columns), self.lap_master_dtypes),
+                self.apply_master_schema(pd.DataFrame(columns=session_columns), self.session_master_dtypes))
+
+    def get_all_laps_and_sessions_per_year_df(self, year, refresh=False):
+        '''
+        :param year: the year we're interested in.
+        :param refresh: if True, check the api for new or changed sessions and add them to the cached masters.
+        :return: lapdf of all laps for races and sprints for the given year, sessiondf containing all metadata for all sessions (race/sprints)
+        '''
+        masters = None if refresh else self.load_masters(year, analysis_only=True)
+        if masters is None:
+            masters = self.refresh_season_masters(year)
+        return self.combine_laps_and_session(*masters)
 
-        sessiondf.rename(columns={'country_name': 'session_country',
-                                  'full_name':'driver_name',
-                                  'name_acronym':'driver_short',
-                                  'tyre_age_at_start':'initial_tire_age',
-                                  'circuit_short_name':'track_name',
-                                  'date_start':'date'},
-                         inplace=True)
+    def concat_masters(self, frames):
+        '''
+        Concatenate combined season frames, unifying the categories of categorical columns so they stay
+        categorical (pd.concat falls back to object when the categories differ).
+        :param frames: list of combined lap/session dfs, one per season.
+        :return: single df of all seasons.
+        '''
+        frames = list(frames)
+        if len(frames) == 1:
+            return frames[0]
+        dtypes = {}
+        for col in frames[0].columns:
+            if all(isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames):
+                categories = pd.Index([]).append([f[col].cat.categories for f in frames]).unique()
+                dtypes[col] = pd.CategoricalDtype(categories)
+        return pd.concat([f.astype(dtypes) for f in frames], ignore_index=True)
 
-        lapdf.rename(columns={'date_start': 'date',
-                              'duration_sector_1':'sector_1',
-                              'duration_sector_2':'sector_2',
-                              'duration_sector_3':'sector_3',
-                              'lap_duration':'lap_seconds',
-                              'segments_sector_1':'s1_segs',
-                              'segments_sector_2':'s2_segs',
-                              'segments_sector_3':'s3_segs'},
-                     inplace=True)
+    def get_all_laps_and_sessions_df(self, years, refresh=False):
+        '''
+        Build or load several seasons at once, each season in its own process.
+        :param years: iterable of seasons.
+        :param refresh: if True, incrementally refresh each season's masters (see refresh_season_masters).
+        :return: combined lap/session df of all the seasons, in the order given.
+        '''
+        years = list(years)
+        if len(years) == 1:
+            return self.get_all_laps_and_sessions_per_year_df(years[0], refresh=refresh)
+        processes = min(len(years), self.season_processes or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            frames = list(pool.map(load_season_df, years, [refresh] * len(years)))
+        return self.concat_masters(frames)
 
+    def lap_store_seasons(self):
+        '''
+        :return: sorted list of seasons in the lap store.
+        '''
+        if not os.path.isdir(self.lap_store_root):
+            return []
+        return sorted(int(name.partition('=')[2]) for name in os.listdir(self.lap_store_root)
+                      if name.startswith('year=') and name.partition('=')[2].isdigit()
+                      and os.path.exists(os.path.join(self.lap_store_root, name, '_current.json')))
 
-        sessiondf.to_csv(cached_session_path, index=False)
-        lapdf.to_csv(cached_laps_path, index=False)
+    def lap_store_pointer(self, year):
+        '''
+        :return: {'build_id':..., 'masters':...} of the season's current build in the lap store, None if it has none.
+        '''
+        pointer_path = os.path.join(self.lap_store_root, f'year={year}', '_current.json')
+        return self.read_json_file(pointer_path) if os.path.exists(pointer_path) else None
 
-        return self.combine_laps_and_session(lapdf, sessiondf)
+    def masters_stamp(self, year):
+        '''
+        :return: modification time and size of the season masters, to tell whether they changed since a lap store
+            build, None if they aren't cached.
+        '''
+        stamp = []
+        for kind in ('laps', 'session'):
+            path = self.master_path(year, kind)
+            if not os.path.exists(path):
+                return None
+            stat = os.stat(path)
+            stamp.append([stat.st_mtime_ns, stat.st_size])
+        return stamp
 
+    def lap_store_files(self, year, build_id):
+        '''
+        :return: paths of a season's partition files of the given build, one per track.
+        '''
+        year_dir = os.path.join(self.lap_store_root, f'year={year}')
+        return [os.path.join(year_dir, name, f'laps-{build_id}.parquet') for name in sorted(os.listdir(year_dir))
+                if os.path.exists(os.path.join(year_dir, name, f'laps-{build_id}.parquet'))]
+
+    def write_lap_store(self, year, season_df, lapdf):
+        '''
+        Replace a season in the lap store.
+        :param year: season of the frames.
+        :param season_df: combined laps & sessions of the season (combine_laps_and_session).
+        :param lapdf: the season's valid, normalized laps (DataFormatter.clean_and_normalize).
+        :return: number of laps stored.
+        '''
+        if pyarrow is None:
+            raise RuntimeError('The lap store needs pyarrow installed.')
+        masters = self.masters_stamp(year)
+        store_df = self.lap_store_rows(season_df, lapdf)
+
+        # The build is written next to the current one and only swapped in by replacing the pointer, so queries
+        # always find the season and never see a half written build.
+        build_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        year_dir = os.path.join(self.lap_store_root, f'year={year}')
+        for track, part in store_df.groupby('track_name', sort=False):
+            part = part.sort_values(self.lap_store_sort_columns, kind='stable').drop(columns=['year', 'track_name'])
+            part_dir = os.path.join(year_dir, 'track_name=' + quote(track, safe=''))
+            os.makedirs(part_dir, exist_ok=True)
+            pyarrow.parquet.write_table(pyarrow.Table.from_pandas(part, preserve_index=False),
+                                        os.path.join(part_dir, f'laps-{build_id}.parquet'),
+                                        row_group_size=self.lap_store_row_group_rows)
+        os.makedirs(year_dir, exist_ok=True)
+        previous = self.lap_store_pointer(year)
+        pointer_path = os.path.join(year_dir, '_current.json')
+        self.write_json_file(f'{pointer_path}.{build_id}.tmp', {'build_id': build_id, 'masters': masters})
+        os.replace(f'{pointer_path}.{build_id}.tmp', pointer_path)
+        # The previous build is kept for queries that read the pointer just before the swap, older ones are removed.
+        self.prune_lap_store(year, previous['build_id'] if previous else build_id)
+        return len(store_df)
+
+    def lap_store_rows(self, season_df, lapdf):
+        '''
+        :return: the rows the lap store keeps for a season: every lap, flagged with whether it's valid and given its
+            normalized times if so.
+        '''
+        keys = ['session_key', 'driver_number', 'lap_number']
+        store_df = season_df.merge(lapdf[keys + ['normalized_lap_seconds', 'lap_time_percentage_compared_to_average']]
+                                   .assign(valid_lap=True), on=keys, how='left')
+        store_df['valid_lap'] = store_df['valid_lap'].notna()
+        # Categoricals are stored as plain strings: the statistics the row groups are pruned by are only kept for
+        # the values, and the categories of different seasons needn't agree. query_laps casts them back.
+        categories = store_df.select_dtypes('category').columns
+        return store_df.astype({col: object for col in categories})
+
+    def prune_lap_store(self, year, oldest_kept):
+        year_dir = os.path.join(self.lap_store_root, f'year={year}')
+        for name in os.listdir(year_dir):
+            part_dir = os.path.join(year_dir, name)
+            if not os.path.isdir(part_dir):
+                continue
+            for file_name in os.listdir(part_dir):
+                if file_name.partition('-')[2].removesuffix('.parquet') < oldest_kept:
+                    os.remove(os.path.join(part_dir, file_name))
+            if not os.listdir(part_dir):
+                os.rmdir(part_dir)
+
+    def build_lap_store(self, year, refresh=False):
+        '''
+        Build a season's lap store partitions from its masters.
+        :param refresh: if True, refresh the season masters from the api first (see refresh_season_masters).
+        :return: number of laps stored.
+        '''
+        season_df = self.get_all_laps_and_sessions_per_year_df(year, refresh=refresh)
+        return self.write_lap_store(year, season_df, DataFormatter().clean_and_normalize(season_df))
+
+    def lap_store_partitioning(self):
+        return pyarrow.dataset.partitioning(pyarrow.schema([('year', pyarrow.int16()), ('track_name', pyarrow.string())]),
+                                            flavor='hive')
+
+    @profiled('lap_query')
+    def query_laps(self, drivers=None, tracks=None, years=None, compounds=None, stint_numbers=None, laps_in_stint=None,
+                   valid_only=False, columns=None):
+        '''
+        Laps from the lap store matching every condition given, e.g. all of a driver's MEDIUM stint laps at a track
+        across seasons:
+            du.query_laps(drivers=['Max VERSTAPPEN'], tracks=['Sakhir'], compounds=['MEDIUM'])
+        Seasons asked for that aren't in the store yet, or whose masters changed since they were stored, are built
+        from their masters first.
+        :param drivers: driver names to keep, None keeps every driver. Likewise for the other list conditions.
+        :param tracks: track names to keep.
+        :param years: seasons to keep, None for every season in the store.
+        :param compounds: tire compounds to keep.
+        :param stint_numbers: stint numbers to keep.
+        :param laps_in_stint: positions within the stint (1 = first lap of the stint) to keep.
+        :param valid_only: only keep the laps DataFormatter.remove_invalid_lap_times keeps.
+        :param columns: columns to return, None for all of them.
+        :return: df of the matching laps, with 'valid_lap', 'normalized_lap_seconds' and
+            'lap_time_percentage_compared_to_average' (NaN for invalid laps) besides the combined lap/session columns.
+        '''
+        if pyarrow is None:
+            raise RuntimeError('The lap store needs pyarrow installed.')
+        files = []
+        for year in years if years is not None else (self.lap_store_seasons() or self.cached_seasons()):
+            pointer = self.lap_store_pointer(year)
+            masters = self.masters_stamp(year)
+            # Seasons whose masters were refreshed since they were stored are rebuilt.
+            if pointer is None or (masters is not None and pointer['masters'] != masters):
+                self.build_lap_store(year)
+                pointer = self.lap_store_pointer(year)
+            files.extend(self.lap_store_files(year, pointer['build_id']))
+
+        conditions = {'driver_name': drivers, 'track_name': tracks, 'compound': compounds,
+                      'stint_number': stint_numbers, 'lap_in_stint': laps_in_stint}
+        filters = [(col, 'in', list(values)) for col, values in conditions.items() if values is not None]
+        if valid_only:
+            filters.append(('valid_lap', '==', True))
+        if files:
+            dataset = pyarrow.dataset.dataset(files, format='parquet', partitioning=self.lap_store_partitioning(),
+                                              partition_base_dir=self.lap_store_root)
+            df = dataset.to_table(columns=columns,
+                                  filter=pyarrow.parquet.filters_to_expression(filters) if filters else None).to_pandas()
+        else:
+            # No season to read, an empty frame with the columns a query of a stored one has (partition columns last).
+            season_df = self.combine_laps_and_session(*self.empty_masters())
+            df = self.lap_store_rows(season_df, season_df.assign(normalized_lap_seconds=np.nan,
+                                                                 lap_time_percentage_compared_to_average=np.nan))
+            df = df[[col for col in df.columns if col not in ('year', 'track_name')] + ['year', 'track_name']]
+            df = df[columns] if columns is not None else df
+        categories = {col: 'category' for col, dtype in self.session_master_dtypes.items()
+                      if dtype == 'category' and col in df.columns}
+        return df.astype(categories)
 
 
+def load_season_df(year, refresh=False):
+    '''
+    Process pool entry point for DataUtility.get_all_laps_and_sessions_df.
+    '''
+    return DataUtility().get_all_laps_and_sessions_per_year_df(year, refresh=refresh)
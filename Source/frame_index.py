@@ -0,0 +1,32 @@
+import numpy as np
+
+
+class DriverTrackIndex:
+    """
+    Per (track_name, driver_name) partial aggregates, built once at load time. Metrics of a driver/track selection
+    are combined from the partials of the selected partitions, rather than recomputed from the laps on every
+    selection change.
+    """
+    def __init__(self):
+        self.partials = {}
+
+    def add_partials(self, name, partial_df):
+        """
+        :param name: name to store the partials under.
+        :param partial_df: partial aggregates, with track_name and driver_name index levels.
+        """
+        self.partials[name] = partial_df
+
+    def select_partials(self, name, driver_filter=None, track_filter=None):
+        """
+        :param driver_filter: list of driver names to keep, empty/None keeps all drivers.
+        :param track_filter: list of track names to keep, empty/None keeps all tracks.
+        :return: rows of the named partials belonging to the partitions matching the filters.
+        """
+        partial_df = self.partials[name]
+        mask = np.ones(len(partial_df), dtype=bool)
+        if track_filter:
+            mask &= partial_df.index.get_level_values('track_name').isin(track_filter)
+        if driver_filter:
+            mask &= partial_df.index.get_level_values('driver_name').isin(driver_filter)
+        return partial_df.loc[mask]
@@ -0,0 +1,288 @@
+import bisect
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_import import DataUtility
+
+
+def same_row(old, new):
+    # NaN never equals itself, so running laps would otherwise look changed on every poll.
+    return old is not None and all(old.get(col) == value or (pd.isna(value) and pd.isna(old.get(col)))
+                                   for col, value in new.items())
+
+
+class DriverLaps:
+    """
+    Laps of one driver in a live session. Timed laps are also kept sorted by lap time, so the median lap time
+    (and the validity threshold derived from it) can be updated as each lap arrives.
+    """
+    def __init__(self):
+        self.lap_seconds = {}     # lap_number -> lap_seconds, NaN while the lap is running or if it was never timed
+        self.pit_out = {}         # lap_number -> is_pit_out_lap
+        self.valid = {}           # lap_number -> lap_validity
+        self.sorted_times = []    # (lap_seconds, lap_number) of the timed laps, ascending
+        self.last_timed_lap = 0
+        # lap_number -> lap_seconds of the laps that pass every check, and their running sums for the average
+        # normalized lap time.
+        self.clean = {}
+        self.clean_seconds = 0.0
+        self.clean_lap_numbers = 0
+
+    def threshold(self):
+        '''
+        :return: validity threshold, 1.25 times the median lap time (see DataFormatter.remove_invalid_lap_times),
+            NaN if no lap has been timed yet.
+        '''
+        n = len(self.sorted_times)
+        if not n:
+            return np.nan
+        mid = n // 2
+        median = self.sorted_times[mid][0] if n % 2 else (self.sorted_times[mid - 1][0] + self.sorted_times[mid][0]) / 2
+        return median * 1.25
+
+
+class LiveSession:
+    """
+    Follows a session while it is running, polling the laps endpoint for new laps and keeping lap validity,
+    field slowing events and normalized lap times up to date incrementally, with the same rules as
+    DataFormatter.remove_invalid_lap_times and normalize_lap_times apply to a finished session.
+
+    Work per poll is proportional to the laps that arrived or changed since the last one:
+    - each driver's timed laps are kept sorted, so the median moves with an insort, and only the laps whose time
+      falls between the old and new threshold can change validity.
+    - the number of valid laps for each lap number is kept as a count, so a field slowing event is a lookup.
+    - normalized times are linear in lap_seconds and lap_number, so each driver's average normalized lap time
+      comes from running sums of their valid laps.
+    Polls only ask for laps from the slowest running driver's current lap onwards. driver_summary() is built from the
+    running state too, but snapshot() isn't incremental, see there.
+
+    While the session runs, its total lap count isn't known. Unless total_laps is given, it's estimated the same way
+    as for a finished session (the most laps any driver has done, or 57 until that passes 44), so a session followed
+    to the end ends up with exactly the batch results.
+    """
+    field_min_valid_laps = 10
+    # Drivers more than this many laps behind the leader (retired, or a long stop) no longer hold back where polls start.
+    active_lap_window = 3
+    poll_interval = 5
+
+    def __init__(self, session_key, du=None, total_laps=None):
+        '''
+        :param session_key: session to follow.
+        :param du: DataUtility used to request the session, e.g. pointed at a replay server.
+        :param total_laps: scheduled race distance, if known.
+        '''
+        self.session_key = session_key
+        self.du = du or DataUtility()
+        self.total_laps = total_laps
+        self.drivers = {}        # driver_number -> DriverLaps
+        self.rows = {}           # (driver_number, lap_number) -> latest lap row from the api
+        self.field_counts = {}   # lap_number -> number of drivers with a valid lap
+        self.lap_drivers = {}    # lap_number -> driver numbers that have the lap
+        self.driver_names = {}
+        self.version = 0
+        self.polled_at = None
+        self.snapshot_cache = (None, None)
+        self.lock = threading.Lock()
+
+    def poll_from(self):
+        '''
+        :return: first lap number that can still arrive or change: the lap after the last timed lap of the
+            slowest driver still running.
+        '''
+        if not self.drivers:
+            return 1
+        last_timed = [laps.last_timed_lap for laps in self.drivers.values()]
+        leader = max(last_timed)
+        return min(lap for lap in last_timed if lap >= leader - self.active_lap_window) + 1
+
+    def poll(self, min_interval=None):
+        '''
+        Request the laps that arrived or changed since the last poll and apply them.
+        :param min_interval: skip the poll if the last one was less than this many seconds ago, e.g. when several
+            viewers share the session.
+        :return: number of laps added or updated.
+        '''
+        with self.lock:
+            if min_interval and self.polled_at is not None and time.time() - self.polled_at < min_interval:
+                return 0
+            params = {'session_key': str(self.session_key)}
+            first_lap = self.poll_from()
+            if first_lap > 1:
+                # The api's lap_number>= filter.
+                params['lap_number>'] = str(first_lap)
+            lapdf = self.du.request_df('laps', params, cache=False, store=False,
+                                       renames=self.du.lap_api_renames, dtypes=self.du.lap_master_dtypes)
+            self.polled_at = time.time()
+            changed = self.ingest(lapdf)
+            # Asked again on every poll until each driver seen has a name.
+            if not self.drivers.keys() <= self.driver_names.keys():
+                self.refresh_driver_names()
+            return changed
+
+    def refresh_driver_names(self):
+        driverdf = self.du.request_df('drivers', {'session_key': str(self.session_key)}, cache=False, store=False)
+        if len(driverdf):
+            driverdf = driverdf.loc[driverdf['full_name'].notna()]
+            driver_names = dict(zip(driverdf['driver_number'], driverdf['full_name']))
+            if driver_names != self.driver_names:
+                # Snapshots carry the names, so they need rebuilding.
+                self.driver_names = driver_names
+                self.version += 1
+
+    def ingest(self, lapdf):
+        '''
+        Apply laps from the api, with master column names. Laps already seen are updated if they changed
+        (e.g. a running lap that now has its time).
+        :return: number of laps added or updated.
+        '''
+        changed = 0
+        for row in lapdf.to_dict('records'):
+            key = (row['driver_number'], row['lap_number'])
+            if same_row(self.rows.get(key), row):
+                continue
+            self.rows[key] = row
+            self.update_lap(row['driver_number'], row['lap_number'], row['lap_seconds'], row['is_pit_out_lap'] == True)
+            changed += 1
+        if changed:
+            self.version += 1
+        return changed
+
+    def update_lap(self, driver_number, lap_number, lap_seconds, pit_out):
+        laps = self.drivers.get(driver_number)
+        if laps is None:
+            laps = self.drivers[driver_number] = DriverLaps()
+        old_threshold = laps.threshold()
+
+        old_seconds = laps.lap_seconds.get(lap_number, np.nan)
+        if not np.isnan(old_seconds):
+            laps.sorted_times.remove((old_seconds, lap_number))
+        laps.lap_seconds[lap_number] = lap_seconds
+        laps.pit_out[lap_number] = pit_out
+        self.lap_drivers.setdefault(lap_number, set()).add(driver_number)
+        if not np.isnan(lap_seconds):
+            bisect.insort(laps.sorted_times, (lap_seconds, lap_number))
+            laps.last_timed_lap = max(laps.last_timed_lap, lap_number)
+        new_threshold = laps.threshold()
+
+        # Laps faster than both thresholds stay valid and laps at or over both stay invalid, only those in between flip.
+        if np.isnan(old_threshold) or np.isnan(new_threshold):
+            recheck = laps.sorted_times
+        else:
+            lo, hi = sorted((old_threshold, new_threshold))
+            recheck = laps.sorted_times[bisect.bisect_left(laps.sorted_times, (lo,)):
+                                        bisect.bisect_left(laps.sorted_times, (hi,))]
+        for seconds, number in recheck:
+            self.set_validity(driver_number, number, seconds < new_threshold)
+        self.set_validity(driver_number, lap_number, bool(lap_seconds < new_threshold))
+        self.update_clean(driver_number, lap_number)
+
+    def set_validity(self, driver_number, lap_number, valid):
+        laps = self.drivers[driver_number]
+        if laps.valid.get(lap_number, False) == valid:
+            laps.valid.setdefault(lap_number, valid)
+            return
+        laps.valid[lap_number] = valid
+        was_field_valid = self.field_valid(lap_number)
+        self.field_counts[lap_number] = self.field_counts.get(lap_number, 0) + (1 if valid else -1)
+        if self.field_valid(lap_number) != was_field_valid:
+            # The lap number crossed into or out of a field slowing event, every driver's lap is affected.
+            for number in self.lap_drivers[lap_number]:
+                self.update_clean(number, lap_number)
+        else:
+            self.update_clean(driver_number, lap_number)
+
+    def field_valid(self, lap_number):
+        return self.field_counts.get(lap_number, 0) > self.field_min_valid_laps
+
+    def update_clean(self, driver_number, lap_number):
+        '''
+        Bring a lap's contribution to its driver's running sums in line with whether it passes every check.
+        '''
+        laps = self.drivers[driver_number]
+        seconds = laps.lap_seconds[lap_number]
+        clean = laps.valid.get(lap_number, False) and self.field_valid(lap_number) and not laps.pit_out[lap_number]
+        if lap_number in laps.clean and (not clean or laps.clean[lap_number] != seconds):
+            laps.clean_seconds -= laps.clean.pop(lap_number)
+            laps.clean_lap_numbers -= lap_number
+        if clean and lap_number not in laps.clean:
+            laps.clean[lap_number] = seconds
+            laps.clean_seconds += seconds
+            laps.clean_lap_numbers += lap_number
+
+    def total_session_laps(self):
+        if self.total_laps:
+            return self.total_laps
+        session_laps = max((len(laps.lap_seconds) for laps in self.drivers.values()), default=0)
+        return session_laps if session_laps > 44 else 57
+
+    def fuel_correction(self, lap_number, total_laps):
+        # See DataFormatter.normalize_lap_times.
+        return (110 - ((110 / total_laps) * (lap_number - .5))) * .03
+
+    def driver_summary(self):
+        '''
+        :return: df with a row per driver: laps, valid laps, validity threshold and average normalized lap time.
+            Built from the running state, without touching individual laps.
+        '''
+        total_laps = self.total_session_laps()
+        rows = []
+        for number, laps in self.drivers.items():
+            count = len(laps.clean)
+            rows.append({'driver_number': number,
+                         'driver_name': self.driver_names.get(number),
+                         'laps': len(laps.lap_seconds),
+                         'valid_laps': count,
+                         'valid_lap_threshold': laps.threshold(),
+                         'average_normalized_lap_seconds': laps.clean_seconds / count - self.fuel_correction(laps.clean_lap_numbers / count, total_laps)
+                                                           if count else np.nan})
+        return pd.DataFrame(rows, columns=['driver_number', 'driver_name', 'laps', 'valid_laps', 'valid_lap_threshold',
+                                           'average_normalized_lap_seconds'])
+
+    def snapshot(self):
+        '''
+        :return: df with every lap seen so far and its validity flags ('lap_validity', 'field_valid_lap',
+            'valid'), plus 'total_session_laps', 'normalized_lap_seconds', 'average_normalized_lap_seconds' and
+            'lap_time_percentage_compared_to_average' for valid laps (NaN otherwise).
+            Only rebuilt after laps change, and shared between callers, so it must not be modified.
+            Unlike polling, a rebuild costs time proportional to the whole session so far, not to the laps that
+            changed: every valid lap's normalized time and percentage move with its driver's average and with the
+            estimated race distance, which can change on any poll. Use driver_summary() where per lap rows aren't needed.
+        '''
+        with self.lock:
+            version, df = self.snapshot_cache
+            if version == self.version:
+                return df
+            df = pd.DataFrame(list(self.rows.values()))
+            if not len(df):
+                df = pd.DataFrame(columns=['driver_number', 'lap_number', 'lap_seconds', 'is_pit_out_lap'])
+            df = df.sort_values(['driver_number', 'lap_number'], ignore_index=True)
+            keys = list(zip(df['driver_number'], df['lap_number']))
+            df['driver_name'] = df['driver_number'].map(self.driver_names)
+            df['lap_validity'] = [self.drivers[d].valid[n] for d, n in keys]
+            df['field_valid_lap'] = [self.field_valid(n) for n in df['lap_number']]
+            df['valid'] = [n in self.drivers[d].clean for d, n in keys]
+            df['total_session_laps'] = total_laps = self.total_session_laps()
+            averages = self.driver_summary().set_index('driver_number')['average_normalized_lap_seconds']
+            normalized = df['lap_seconds'] - self.fuel_correction(df['lap_number'], total_laps)
+            df['normalized_lap_seconds'] = normalized.where(df['valid'])
+            df['average_normalized_lap_seconds'] = df['driver_number'].map(averages).where(df['valid'])
+            df['lap_time_percentage_compared_to_average'] = round(((df['normalized_lap_seconds'] - df['average_normalized_lap_seconds']) / df['average_normalized_lap_seconds']) * 100, 2)
+            self.snapshot_cache = (self.version, df)
+            return df
+
+    def follow(self, stop=None, on_update=None, interval=None):
+        '''
+        Poll until stop is set.
+        :param stop: threading.Event ending the loop, None to poll forever.
+        :param on_update: called with this LiveSession after each poll that changed any laps.
+        :param interval: seconds between polls, poll_interval by default.
+        '''
+        stop = stop or threading.Event()
+        interval = interval or self.poll_interval
+        while not stop.is_set():
+            if self.poll() and on_update:
+                on_update(self)
+            stop.wait(interval)
@@ -0,0 +1,167 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Stage:
+    """
+    One timed run of a pipeline stage. Call done() with the stage's output to record rows out.
+    """
+    def __init__(self, profiler, name, frame_in):
+        self.profiler = profiler
+        self.record = {'stage': name, 'rows_in': frame_rows(frame_in), 'mb_in': frame_mb(frame_in)}
+        self.frame_out = None
+        self.start = time.perf_counter()
+
+    def done(self, frame_out):
+        self.frame_out = frame_out
+        return frame_out
+
+    def finish(self):
+        self.record['seconds'] = round(time.perf_counter() - self.start, 6)
+        self.record['rows_out'] = frame_rows(self.frame_out)
+        self.record['mb_out'] = frame_mb(self.frame_out)
+        self.record['time'] = datetime.now().isoformat()
+        self.profiler.emit(self.record)
+
+
+class NullStage:
+    def done(self, frame_out):
+        return frame_out
+
+
+# pandas is imported where frames are inspected rather than up front, so importing the profiler (e.g. before the
+# dashboard's first render) doesn't pull pandas in. The frames measured already imply it is loaded.
+def frame_rows(frame):
+    import pandas as pd
+    if isinstance(frame, (tuple, list)):
+        frame = frame[0] if frame else None
+    if isinstance(frame, (pd.DataFrame, pd.Series)):
+        return len(frame)
+    return None
+
+
+def frame_mb(frame):
+    import pandas as pd
+    if isinstance(frame, (tuple, list)):
+        frame = frame[0] if frame else None
+    if isinstance(frame, pd.DataFrame):
+        return round(frame.memory_usage(deep=True, index=True).sum() / 1024 ** 2, 3)
+    if isinstance(frame, pd.Series):
+        return round(frame.memory_usage(deep=True, index=True) / 1024 ** 2, 3)
+    return None
+
+
+class StageProfiler:
+    """
+    Records wall time, rows in/out and frame memory for each pipeline stage.
+
+    Profiling is off unless either:
+    - the F1_PROFILE environment variable is set: '1'/'true' writes a json line per stage to stderr,
+      anything else is taken as a file to append the json lines to.
+    - records are being collected on the current thread, via the profiling() context manager or
+      start_collecting()/stop_collecting(). Collection is per thread, so stages run on worker threads
+      (e.g. parsing each session's files during a fetch) only show up in the environment variable output.
+    """
+    def __init__(self):
+        self.sink = os.environ.get('F1_PROFILE', '')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.sink) or bool(getattr(self.local, 'collectors', None))
+
+    def start_collecting(self):
+        """
+        :return: list that records of stages run on this thread are appended to, until stop_collecting is called.
+        """
+        records = []
+        if not hasattr(self.local, 'collectors'):
+            self.local.collectors = []
+        self.local.collectors.append(records)
+        return records
+
+    def stop_collecting(self, records):
+        self.local.collectors.remove(records)
+        return records
+
+    def emit(self, record):
+        for records in getattr(self.local, 'collectors', []):
+            records.append(record)
+        if not self.sink:
+            return
+        line = json.dumps(record)
+        with self.lock:
+            if self.sink.lower() in ('1', 'true'):
+                print(line, file=sys.stderr)
+            else:
+                with open(self.sink, 'a') as f:
+                    f.write(line + '\n')
+
+    def mark(self, name, start):
+        """
+        Record the time from start (a time.perf_counter() value) to now as a stage, for milestones that don't
+        wrap a single block, e.g. time to first render.
+        :return: the seconds recorded.
+        """
+        seconds = round(time.perf_counter() - start, 6)
+        if self.enabled:
+            self.emit({'stage': name, 'seconds': seconds, 'rows_in': None, 'mb_in': None, 'rows_out': None,
+                       'mb_out': None, 'time': datetime.now().isoformat()})
+        return seconds
+
+    @contextmanager
+    def stage(self, name, frame_in=None):
+        """
+        Time a block as a stage:
+            with profiler.stage('merge', lapdf) as stage:
+                fulldf = stage.done(lapdf.merge(...))
+        """
+        if not self.enabled:
+            yield NullStage()
+            return
+        stage = Stage(self, name, frame_in)
+        try:
+            yield stage
+        finally:
+            stage.finish()
+
+
+profiler = StageProfiler()
+
+
+def profiled(name):
+    """
+    Decorator recording a method as a stage. Rows in are taken from the first dataframe argument, rows out from the result.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            import pandas as pd
+            frame_in = next((a for a in args if isinstance(a, (pd.DataFrame, pd.Series))), None)
+            with profiler.stage(name, frame_in) as stage:
+                return stage.done(func(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profiling():
+    """
+    Collect the stage records of everything run on this thread inside the block:
+        with profiling() as records:
+            ...
+    """
+    records = profiler.start_collecting()
+    try:
+        yield records
+    finally:
+        profiler.stop_collecting(records)
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ResponseCache:
+    """
+    Content addressed cache of api responses, shared by every process and thread using the same root.
+
+    Bodies are stored once per distinct content under objects/, named by their sha256. An sqlite index maps each
+    normalized url to its body along with its size, fetch time, ttl and the http validators used to revalidate it,
+    so a lookup is a single indexed query rather than a series of filesystem calls.
+
+    Bodies are written to a temp file and renamed into place, and every index change that creates or deletes a body
+    runs in an sqlite write transaction, so processes reading and writing the cache at once never see a partial body.
+    A body can still be evicted by another process between looking it up and opening it, which readers must treat as
+    a miss. Least recently used entries are evicted once the stored bodies exceed max_bytes.
+    """
+    # Temp files of writers that crashed before committing or aborting are removed once they're this old.
+    stale_temp_seconds = 60 * 60
+
+    def __init__(self, root='Data/cache', max_bytes=1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.sqlite')
+        # sqlite connections can't be shared between threads, each thread opens its own.
+        self.local = threading.local()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'url TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'fetched_at REAL NOT NULL, last_used REAL NOT NULL, ttl REAL NOT NULL, '
+                         'etag TEXT, last_modified TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_digest ON responses (digest)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Autocommit, transactions are opened explicitly. WAL lets readers carry on while another process writes.
+            conn = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction, taking the database write lock up front so concurrent writers queue rather than deadlock.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        :param url: normalized url of the response.
+        :return: dict of the entry's digest, size, fetched_at, ttl, etag, last_modified, path and fresh,
+            or None if the url isn't cached. The entry is marked as used.
+        """
+        now = time.time()
+        row = self.connection().execute(
+            'UPDATE responses SET last_used = ? WHERE url = ? '
+            'RETURNING digest, size, fetched_at, ttl, etag, last_modified', (now, url)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['path'] = self.object_path(entry['digest'])
+        entry['fresh'] = now < entry['fetched_at'] + entry['ttl']
+        return entry
+
+    def touch(self, url):
+        """
+        Restart an entry's ttl, after the server confirmed it is still current.
+        """
+        now = time.time()
+        self.connection().execute('UPDATE responses SET fetched_at = ?, last_used = ? WHERE url = ?', (now, now, url))
+
+    def writer(self, url, ttl, etag=None, last_modified=None):
+        """
+        :param url: normalized url of the response.
+        :param ttl: seconds the response stays fresh for.
+        :param etag: ETag validator of the response.
+        :param last_modified: Last-Modified validator of the response.
+        :return: CacheWriter to write the body to, the entry is only stored once the writer is committed.
+        """
+        return CacheWriter(self, url, ttl, etag, last_modified)
+
+    def store(self, url, body, ttl, etag=None, last_modified=None):
+        writer = self.writer(url, ttl, etag, last_modified)
+        writer.write(body)
+        return writer.commit()
+
+    def add_entry(self, url, temp_path, digest, size, ttl, etag, last_modified):
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        now = time.time()
+        with self.transaction() as conn:
+            if os.path.exists(path):
+                # Same content is already stored, possibly under another url.
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, path)
+            old = conn.execute('SELECT digest FROM responses WHERE url = ?', (url,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO responses (url, digest, size, fetched_at, last_used, ttl, etag, last_modified) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (url, digest, size, now, now, ttl, etag, last_modified))
+            if old is not None and old['digest'] != digest:
+                self.remove_unreferenced(conn, old['digest'])
+        self.evict()
+        return path
+
+    def remove_unreferenced(self, conn, digest):
+        """
+        Delete a body no entry refers to any more. Must be called inside a transaction.
+        :return: True if the body was deleted.
+        """
+        if conn.execute('SELECT 1 FROM responses WHERE digest = ? LIMIT 1', (digest,)).fetchone():
+            return False
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def total_bytes(self, conn=None):
+        conn = conn or self.connection()
+        return conn.execute('SELECT COALESCE(SUM(size), 0) FROM '
+                            '(SELECT MAX(size) AS size FROM responses GROUP BY digest)').fetchone()[0]
+
+    def remove_stale_temp_files(self):
+        """
+        Delete temp files left behind by writers that never committed or aborted, e.g. a process killed mid download.
+        Writers still in progress keep writing to theirs, so only files unmodified for stale_temp_seconds are removed.
+        """
+        cutoff = time.time() - self.stale_temp_seconds
+        for entry in os.scandir(self.objects_dir):
+            if not entry.name.endswith('.tmp'):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """
+        Remove least recently used entries until the stored bodies fit in max_bytes, and stale temp files.
+        """
+        self.remove_stale_temp_files()
+        if self.total_bytes() <= self.max_bytes:
+            return
+        with self.transaction() as conn:
+            total = self.total_bytes(conn)
+            for row in conn.execute('SELECT url, digest, size FROM responses ORDER BY last_used').fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM responses WHERE url = ?', (row['url'],))
+                if self.remove_unreferenced(conn, row['digest']):
+                    total -= row['size']
+
+    def clear(self):
+        with self.transaction() as conn:
+            for row in conn.execute('SELECT DISTINCT digest FROM responses').fetchall():
+                try:
+                    os.remove(self.object_path(row['digest']))
+                except FileNotFoundError:
+                    pass
+            conn.execute('DELETE FROM responses')
+
+
+class CacheWriter:
+    """
+    Temp file a response body is written to as it arrives, hashed on the way. commit() adds it to the cache,
+    abort() throws it away. Nothing is visible in the cache before commit().
+    """
+    def __init__(self, cache, url, ttl, etag=None, last_modified=None):
+        self.cache = cache
+        self.url = url
+        self.ttl = ttl
+        self.etag = etag
+        self.last_modified = last_modified
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.objects_dir, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        """
+        :return: path of the stored body.
+        """
+        self.file.close()
+        return self.cache.add_entry(self.url, self.temp_path, self.hash.hexdigest(), self.size,
+                                    self.ttl, self.etag, self.last_modified)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class ResultsCache:
+    """
+    Least recently used cache for analysis results, bounded both by entry count and by the memory held by the
+    cached dataframes. Entries are evicted oldest-use first until both limits are met.
+    Cached results are shared between callers, so they must be treated as read only.
+    """
+    def __init__(self, max_entries=64, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def result_size(self, result):
+        """
+        :param result: a dataframe/series, or a tuple/list of them.
+        :return: approximate memory held by the result in bytes.
+        """
+        if isinstance(result, (tuple, list)):
+            return sum(self.result_size(r) for r in result)
+        if isinstance(result, pd.DataFrame):
+            return int(result.memory_usage(deep=True, index=True).sum())
+        if isinstance(result, pd.Series):
+            return int(result.memory_usage(deep=True, index=True))
+        return 0
+
+    def get(self, key):
+        """
+        :param key: hashable key of the result.
+        :return: the cached result, or None if it isn't cached.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, result):
+        size = self.result_size(result)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            # A single result bigger than the whole cache is never stored.
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (result, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def get_or_compute(self, key, compute):
+        """
+        :param key: hashable key of the result.
+        :param compute: function with no arguments building the result on a miss.
+        :return: the cached or newly computed result.
+        """
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
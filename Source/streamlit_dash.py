@@ -1,211 +1,388 @@
-import streamlit as st
-import altair as alt
-import pandas as pd
-
-from data_import import DataUtility
-from data_formatter import DataFormatter
-
-di = DataUtility()
-dc = DataFormatter()
-
-masterdf = di.get_all_laps_and_sessions_per_year_df(2023)
-stint_compound_df, compound_df, stint_df = dc.analyze_stint_df(masterdf)
-master_lapdf = dc.normalize_lap_times(dc.remove_invalid_lap_times(masterdf))
-
-altair_color_dict = {'HARD': 'white', 'MEDIUM': 'gold', 'SOFT': 'firebrick', 'INTERMEDIATE': 'seagreen', 'WET': 'royalblue'}
-streamlit_color_dict = {'HARD': '#ffffff', 'MEDIUM': '#f3d61e', 'SOFT': '#fc3c30', 'INTERMEDIATE': '#368a35', 'WET': '#2458e3'}
-stint_color_list = ['#DAF7A6', '#FFC300', '#FF5733', '#C70039', '#900C3F', '#581845', '#4f2d44', '#392532', '#161215']
-colTitles = ['HARD', 'MEDIUM', 'SOFT', 'WET/INT']
-compoundOrder = {'HARD':0, 'MEDIUM':1, 'SOFT':2, 'INTERMEDIATE':3, 'WET':4}
-
-def filter_df(driver_filter='', track_filter=''):
-    """
-    Update the global dataframes we use to display data, filtering them according to user input.
-    :param driver_filter: list of driver names to filter by.
-    :param track_filter: list of track names to filter by.
-    :return: nothing.
-    """
-    global stint_compound_df, lapdf, compound_df, stint_df
-
-    def filter_master_df(master, dfilter, tfilter):
-        return_df = master.loc[master['driver_name'].isin(dfilter)] if dfilter else master.copy()
-        return_df = return_df.loc[return_df['track_name'].isin(tfilter)] if tfilter else return_df
-        return return_df
-
-    # We get a temporarily filtered masterdf to perform stint/compound based calculations, but we drop it
-    # and don't use it for lap times for reasons outlined below.
-    tempdf = filter_master_df(masterdf, driver_filter, track_filter)
-    stint_compound_df, compound_df, stint_df= dc.analyze_stint_df(tempdf)
-
-    # We filter master_lapdf rather than recalculating with the filtered masterdf because that will throw off some of our
-    # data cleaning, and probably allow laps into the data that we don't actually want.
-    lapdf = filter_master_df(master_lapdf, driver_filter, track_filter)
-
-st.title("F1 2023 SEASON:")
-st.header("TIRE COMPOUND & STINT ANALYSIS")
-
-dcol, tcol = st.columns(2)
-with dcol:
-    driver_options = st.multiselect(
-        "Filter by driver(s)",
-        masterdf['driver_name'].unique(),
-    )
+import time
+script_start = time.perf_counter()
 
-with tcol:
-    track_options = st.multiselect(
-        "Filter by track(s)",
-        masterdf['track_name'].unique(),
+import streamlit as st
+from contextlib import nullcontext
+from datetime import datetime
+
+from artifacts import ArtifactStore, cached_master_seasons
+from profiling import profiler, profiling
+
+# The page is laid out in two passes. First, everything that only needs streamlit and the artifact metadata
+# (season and filter controls), so the page shows up before pandas, altair or the network stack are imported.
+# Then the heavy modules and season data are loaded and the charts filled in below, in page order.
+artifact_store = ArtifactStore()
+
+first_season = 2023
+
+# Optional per-rerun breakdown of where the time went, by pipeline stage.
+show_stage_timings = st.sidebar.checkbox('Show stage timings')
+
+def show_stage_timings_panel():
+    import pandas as pd
+    st.sidebar.subheader('Stage timings (this rerun)')
+    st.sidebar.caption(f'Total rerun: {time.perf_counter() - script_start:.3f}s, first render after {first_render_seconds:.3f}s. '
+                       'Stages served from cache (season load, repeated selections) are not rerun.')
+    st.sidebar.dataframe(pd.DataFrame(stage_records, columns=['stage', 'seconds', 'rows_in', 'rows_out', 'mb_in', 'mb_out']),
+                         hide_index=True)
+
+# Stage records are collected for the whole rerun and collection stops however it ends: st.stop, a rerun
+# triggered by a widget while this one is running, or an error.
+with profiling() if show_stage_timings else nullcontext() as stage_records:
+    # Live mode follows a running session, polling for new laps on its own without rerunning the rest of the page.
+    live_session_key = st.sidebar.number_input('Follow a live session (session key)', min_value=0, value=0, step=1)
+    live_container = st.container()
+
+    season_options = list(range(first_season, datetime.now().year + 1))
+    # Default to the latest offered season that is already built (or at least has cached masters).
+    built_seasons = [year for year in artifact_store.built_seasons() if year in season_options]
+    if built_seasons:
+        default_season = max(built_seasons)
+    else:
+        # Nothing prebuilt to serve, the seasons will be loaded from the masters anyway.
+        cached_seasons = [year for year in cached_master_seasons() if year in season_options]
+        default_season = max(cached_seasons) if cached_seasons else first_season
+
+    selected_seasons = st.multiselect(
+        "Season(s)",
+        season_options,
+        default=[default_season],
     )
+    season_years = tuple(sorted(selected_seasons))
+    season_builds = artifact_store.current_builds(season_years) if season_years else None
+    # Drivers and tracks of the seasons, so the filters can be shown before the season data is loaded.
+    season_metadata = artifact_store.load_metadata(season_years, season_builds) if season_builds else None
 
-filter_df(driver_filter=driver_options, track_filter=track_options)
-pivot_compound_vs_stint = pd.pivot_table(stint_compound_df, values='compound_count_per_stint', index='stint_number', columns=['compound'], aggfunc="sum")
-st.dataframe(pivot_compound_vs_stint[sorted(pivot_compound_vs_stint.columns, key=compoundOrder.get)])
+    if not selected_seasons:
+        st.warning('Select at least one season.')
+    else:
+        st.title(f"F1 {', '.join(str(y) for y in season_years)} SEASON{'S' if len(season_years) > 1 else ''}:")
+        st.header("TIRE COMPOUND & STINT ANALYSIS")
+        dcol, tcol = st.columns(2)
+
+    def show_filters(driver_names, track_names):
+        with dcol:
+            drivers = st.multiselect(
+                "Filter by driver(s)",
+                driver_names,
+            )
+
+        with tcol:
+            tracks = st.multiselect(
+                "Filter by track(s)",
+                track_names,
+            )
+        return drivers, tracks
+
+    if season_metadata:
+        driver_options, track_options = show_filters(season_metadata['drivers'], season_metadata['tracks'])
+    first_render_seconds = profiler.mark('first_render', script_start)
+
+    import altair as alt
+    import numpy as np
+    import pandas as pd
+
+    from data_import import DataUtility
+    from data_formatter import DataFormatter
+    from frame_index import DriverTrackIndex
+    from live_session import LiveSession
+    from results_cache import ResultsCache
+
+    di = DataUtility()
+    dc = DataFormatter()
+
+    @st.cache_resource(max_entries=4)
+    def get_live_session(session_key):
+        # One live session per session key, shared across sessions of the app so the api is only polled once per interval.
+        return LiveSession(session_key)
+
+    @st.fragment(run_every=LiveSession.poll_interval)
+    def show_live_session():
+        live = get_live_session(int(live_session_key))
+        # Every viewer's fragment reruns on the interval, only the first one due polls the api.
+        live.poll(min_interval=LiveSession.poll_interval)
+        live_lapdf = live.snapshot()
+        st.header(f"LIVE SESSION {live.session_key}:")
+        st.caption(f"{len(live_lapdf)} laps, estimated race distance {live.total_session_laps()} laps. "
+                   f"Last polled {datetime.fromtimestamp(live.polled_at).strftime('%H:%M:%S')}.")
+        st.dataframe(live.driver_summary().set_index('driver_number'))
+        valid_laps = live_lapdf.loc[live_lapdf['valid'] == True]
+        if len(valid_laps):
+            st.subheader('Normalized lap times:')
+            # Drivers the api hasn't named yet are shown by number.
+            drivers = valid_laps['driver_name'].fillna(valid_laps['driver_number'].astype(str)).rename('driver')
+            st.line_chart(valid_laps.assign(driver=drivers).pivot(index='lap_number', columns='driver', values='normalized_lap_seconds'))
+
+    if live_session_key:
+        with live_container:
+            show_live_session()
+
+    if not selected_seasons:
+        if show_stage_timings:
+            show_stage_timings_panel()
+        st.stop()
+
+    @st.cache_resource(max_entries=8)
+    def load_season(year, build_id=None):
+        """
+        Load one season once per process, rather than on every rerun. Seasons are cached one at a time, so adding a
+        season to the selection only loads that season, and memory grows with the seasons actually selected.
+        When the season has an artifact build (from artifacts.py) it is read from that, otherwise the season is built
+        here (which can mean fetching it from the api). Only what the dashboard reads is kept: the season's drivers
+        and tracks, the per-driver/track metric partials the metric cube of a selection is combined from, and the
+        partials the degradation models are fit from.
+        The returned frames are shared by every session and must not be modified.
+        :param year: season to load.
+        :param build_id: artifact build of the season (see ArtifactStore.current_build), None to build the season here.
+            Part of the cache key, so a newly published build is picked up on the next rerun.
+        :return: drivers, tracks, metric_partials, degradation_partials
+        """
+        metadata = artifact_store.load_metadata((year,), (build_id,)) if build_id else None
+        if metadata:
+            metric_partials, degradation_partials = artifact_store.load_partials(year, build_id)
+            return metadata['drivers'], metadata['tracks'], metric_partials, degradation_partials
+        season_df = di.get_all_laps_and_sessions_per_year_df(year)
+        lap_time_partials, degradation_partials = dc.lap_partials(dc.clean_and_normalize(season_df))
+        metric_partials = dc.metric_partials(dc.stint_summary_df(season_df), lap_time_partials)
+        return (season_df['driver_name'].dropna().unique().tolist(), season_df['track_name'].dropna().unique().tolist(),
+                metric_partials, degradation_partials)
+
+    @st.cache_resource(max_entries=2)
+    def load_seasons(years, build_ids):
+        """
+        Combine the selected seasons (see load_season) into a driver/track index holding their partials.
+        Only the partials are combined, which are small next to the seasons' laps.
+        :param years: tuple of seasons to load.
+        :param build_ids: tuple of the artifact build of each season, None for seasons without one.
+        :return: driver names, track names (in order of first appearance), master_index
+        """
+        seasons = [load_season(year, build_id) for year, build_id in zip(years, build_ids)]
+        # Partials of different seasons can share driver/track keys, the metric cube and degradation fits sum them.
+        season_index = DriverTrackIndex()
+        season_index.add_partials('metrics', pd.concat([season[2] for season in seasons]))
+        season_index.add_partials('degradation', pd.concat([season[3] for season in seasons]))
+        drivers = list(dict.fromkeys(driver for season in seasons for driver in season[0]))
+        tracks = list(dict.fromkeys(track for season in seasons for track in season[1]))
+        return drivers, tracks, season_index
+
+    @st.cache_resource
+    def get_results_cache():
+        # Filtered results for each season/driver/track selection, shared across sessions.
+        return ResultsCache(max_entries=64, max_bytes=256 * 1024 * 1024)
+
+    results_cache = get_results_cache()
+
+    altair_color_dict = {'HARD': 'white', 'MEDIUM': 'gold', 'SOFT': 'firebrick', 'INTERMEDIATE': 'seagreen', 'WET': 'royalblue'}
+    streamlit_color_dict = {'HARD': '#ffffff', 'MEDIUM': '#f3d61e', 'SOFT': '#fc3c30', 'INTERMEDIATE': '#368a35', 'WET': '#2458e3'}
+    stint_color_list = ['#DAF7A6', '#FFC300', '#FF5733', '#C70039', '#900C3F', '#581845', '#4f2d44', '#392532', '#161215']
+    colTitles = ['HARD', 'MEDIUM', 'SOFT', 'WET/INT']
+    compoundOrder = {'HARD':0, 'MEDIUM':1, 'SOFT':2, 'INTERMEDIATE':3, 'WET':4}
+
+    def filter_df(driver_filter='', track_filter=''):
+        """
+        Update the global dataframes we use to display data, filtering them according to user input.
+        :param driver_filter: list of driver names to filter by.
+        :param track_filter: list of track names to filter by.
+        :return: nothing.
+        """
+        global metric_cube, pivot_compound_vs_stint, compound_df, stint_df, degradation_df
+
+        def compute_filtered_results():
+            # Every metric is read from one (compound x stint_number) cube, combined from the per driver/track
+            # metric partials in a single groupby.
+            cube = dc.metric_cube(master_index.select_partials('metrics', driver_filter, track_filter))
+            pivot, cdf, sdf = dc.analyze_metric_cube(cube)
+            # One degradation model per compound, refit from the selection's partials, with an intercept per track and
+            # driver so their differences in pace don't end up in the slopes.
+            ddf = dc.degradation_curve(dc.fit_degradation(master_index.select_partials('degradation', driver_filter, track_filter),
+                                                          by=('compound',), within=('track_name', 'driver_name')))
+            return cube, pivot, cdf, sdf, ddf
+
+        # Selections are sets, the order drivers/tracks were picked in doesn't change the results.
+        filter_key = (season_years, frozenset(driver_filter), frozenset(track_filter))
+        metric_cube, pivot_compound_vs_stint, compound_df, stint_df, degradation_df = results_cache.get_or_compute(filter_key, compute_filtered_results)
+
+    with st.spinner('Loading season data...'):
+        season_drivers, season_tracks, master_index = load_seasons(
+            season_years, tuple(artifact_store.current_build_id(year) for year in season_years))
+    if not season_drivers:
+        st.warning(f"No race data for {', '.join(str(y) for y in season_years)} yet.")
+        if show_stage_timings:
+            show_stage_timings_panel()
+        st.stop()
+
+    if not season_metadata:
+        driver_options, track_options = show_filters(season_drivers, season_tracks)
+
+    filter_df(driver_filter=driver_options, track_filter=track_options)
+    st.dataframe(pivot_compound_vs_stint[sorted(pivot_compound_vs_stint.columns, key=compoundOrder.get)])
+
+    def get_compound_col(df, compound='', col=''):
+        if compound and col:
+            return df.loc[compound, col] if compound in df.index else 0
+        return 0
+
+    def compound_lap_count(df, compound=''):
+        return int(get_compound_col(df, compound, 'compound_laps'))
+
+    def average_compound_laps(df, compound=''):
+        return round(get_compound_col(df, compound, 'average_compound_laps'), 2)
+
+    def compound_sum(df, compound=''):
+        if compound:
+            return int(df[compound].sum()) if compound in df.columns else 0
+        return 0
+
+    def get_avg_lap_times(df, compound='', stint='', addl_stints=False):
+        """
+        Average normalized lap time, combined from the cells of the metric cube (see DataFormatter.metric_cube).
+        """
+        mask = np.ones(len(df), dtype=bool)
+        if compound:
+            mask &= df.index.get_level_values('compound') == compound
+        if stint:
+            stints = df.index.get_level_values('stint_number')
+            mask &= (stints >= int(stint)) if addl_stints else (stints == int(stint))
+        lap_count = df.loc[mask, 'lap_count'].sum()
+        return round(df.loc[mask, 'lap_seconds_sum'].sum() / lap_count, 2) if lap_count else 'NA'
+
+    def generate_pie_chart(df, value_col, cat_col, color_dict):
+        pie = (
+            alt.Chart(df.reset_index())
+            .mark_arc()
+            .encode(
+                theta=alt.Theta(field=value_col, type='quantitative'),
+                color=alt.Color(field=cat_col).scale(domain=color_dict.keys(),
+                                                        range=color_dict.values()),
+                order=alt.Order(field=value_col, sort='ascending')
+            )
+        )
+        st.altair_chart(pie, use_container_width=True)
+
+    def generate_bar_chart(df, x, y, x_label, y_label):
+        bar = (
+            alt.Chart(df.reset_index())
+            .mark_bar()
+            .encode(
+                x=alt.X(x, sort='-y').title(x_label),
+                y=alt.Y(y).title(y_label),
+                color=alt.Color("color", legend=None).scale(None)
+            )
+            .interactive()
+        )
+        st.altair_chart(bar, use_container_width=True)
+
+    def generate_value_columns(df, func, col_titles=colTitles):
+        cols = st.columns(len(col_titles))
+        for i in range(len(col_titles)):
+            with (cols[i]):
+                if col_titles[i] == 'WET/INT':
+                    val = func(df, 'WET') + func(df, 'INTERMEDIATE')
+                else:
+                    val = func(df, col_titles[i])
+                st.metric(label=col_titles[i], value=val)
+
+    st.header("Analysis / COMPOUND:")
+
+    ############### Display Pie chart of all stint usages. ###############
+    st.subheader('Number of times compound was used')
+    generate_pie_chart(compound_df, 'compound_stint_count', 'compound', altair_color_dict)
+    generate_value_columns(pivot_compound_vs_stint, compound_sum)
+
+    ############### Number of laps run / compound chart ###############
+    st.subheader('Number of laps run per compound')
+    generate_pie_chart(compound_df, 'compound_laps', 'compound', altair_color_dict)
+    generate_value_columns(compound_df, compound_lap_count)
+
+
+    ############### Average life in laps / compound chart ###############
+    st.subheader('Average Laps/Compound')
+    generate_bar_chart(compound_df, 'compound', 'average_compound_laps', 'Compound', 'Laps')
+    generate_value_columns(compound_df, average_compound_laps)
+
+    ############### Times/lap number per stint. ###############
+    # Example: how fast on average is the first lap of a hard stint.
+    st.subheader('Average lap speeds for given compounds (minus wet/int):')
+    generate_value_columns(metric_cube, get_avg_lap_times, col_titles=colTitles[:3])
+
+    #Filter df.
+    # tldf = lapdf.loc[~lapdf['compound'].isin(['WET', 'INTERMEDIATE'])]
+    # pivot_percent_vs_compound = pd.pivot_table(tldf, values='lap_time_percentage_compared_to_average', index='lap_in_stint', columns=['compound'], aggfunc="mean")
+    # pivot_seconds_vs_compound = pd.pivot_table(tldf, values='normalized_lap_seconds', index='lap_in_stint', columns=['compound'], aggfunc="mean")
+    #
+    # #Generate the color list from the compounds that exist.
+    # streamlit_colors = [streamlit_color_dict[col] for col in pivot_seconds_vs_compound.columns]
+    # st.line_chart(data=pivot_percent_vs_compound, color=streamlit_colors)
+    # st.line_chart(data=pivot_seconds_vs_compound, color=streamlit_colors)
+
+    def seconds_lost_by_lap(df, compound='', lap=20):
+        # No stint of the compound in this selection lasted to the lap when the curve stops short of it.
+        return round(df.loc[lap, compound], 2) if compound in df.columns and pd.notna(df.loc[lap, compound]) else 'NA'
+
+    st.subheader('Fitted tire degradation, seconds lost since the first lap of a stint:')
+    if len(degradation_df.columns):
+        st.line_chart(data=degradation_df, color=[streamlit_color_dict[compound] for compound in degradation_df.columns])
+    else:
+        st.warning('No laps to fit tire degradation for in this selection.')
+    st.text('Seconds lost by lap 20 of a stint:')
+    generate_value_columns(degradation_df, seconds_lost_by_lap, col_titles=colTitles[:3])
 
-def get_compound_col(df, compound='', col=''):
-    if compound and col:
-        return df.loc[compound, col] if compound in df.index else 0
-    return 0
+    st.subheader("During which stints was each compound used?")
+    st.bar_chart(pivot_compound_vs_stint.T, stack=False, color=stint_color_list[:len(pivot_compound_vs_stint.index)])
 
-def compound_lap_count(df, compound=''):
-    return int(get_compound_col(df, compound, 'compound_laps'))
 
-def average_compound_laps(df, compound=''):
-    return round(get_compound_col(df, compound, 'average_compound_laps'), 2)
+    st.header("Analysis / STINT:")
+    st.subheader('How often was each compound used for a given stint?')
+    #Populates the altair color list with colors for compounds that exist in our filtered data.
+    altair_color_list = [streamlit_color_dict[compound] for compound in pivot_compound_vs_stint.columns]
+    st.bar_chart(pivot_compound_vs_stint, stack=False, color=altair_color_list)
 
-def compound_sum(df, compound=''):
-    if compound:
-        return int(df[compound].sum()) if compound in df.columns else 0
-    return 0
+    def avg_stint_laps(df, stint=0, avg_remaining=False):
+        if stint != 0:
+            if not avg_remaining:
+                return round(df.loc[stint, 'avg_stint_length'], 2) if stint in df.index else 'NA'
+            else:
+                return round(df.loc[stint:, 'avg_stint_length'].mean(), 2) if stint in df.index else 'NA'
+        return 'NA'
 
-def get_avg_lap_times(df, compound='', stint='', addl_stints=False):
-    cf = df['compound'] == compound if compound else True
-    if not addl_stints:
-        sf = df['stint_number'] == int(stint) if stint else True
-    else:
-        sf = df['stint_number'] >= int(stint) if stint else True
-    return round(df.loc[cf & sf, 'normalized_lap_seconds'].mean(), 2) if not df.loc[cf & sf].empty else 'NA'
-
-def generate_pie_chart(df, value_col, cat_col, color_dict):
-    pie = (
-        alt.Chart(df.reset_index())
-        .mark_arc()
-        .encode(
-            theta=alt.Theta(field=value_col, type='quantitative'),
-            color=alt.Color(field=cat_col).scale(domain=color_dict.keys(),
-                                                    range=color_dict.values()),
-            order=alt.Order(field=value_col, sort='ascending')
-        )
-    )
-    st.altair_chart(pie, use_container_width=True)
-
-def generate_bar_chart(df, x, y, x_label, y_label):
-    bar = (
-        alt.Chart(df.reset_index())
-        .mark_bar()
-        .encode(
-            x=alt.X(x, sort='-y').title(x_label),
-            y=alt.Y(y).title(y_label),
-            color=alt.Color("color", legend=None).scale(None)
-        )
-        .interactive()
-    )
-    st.altair_chart(bar, use_container_width=True)
-
-def generate_value_columns(df, func, col_titles=colTitles):
-    cols = st.columns(len(col_titles))
-    for i in range(len(col_titles)):
-        with (cols[i]):
-            if col_titles[i] == 'WET/INT':
-                val = func(df, 'WET') + func(df, 'INTERMEDIATE')
+    def final_stint_count(df, stint=0, sum_remaining=False):
+        if stint != 0:
+            if not sum_remaining:
+                return round(df.loc[stint, 'final_stint_count'], 2) if stint in df.index else 'NA'
             else:
-                val = func(df, col_titles[i])
-            st.metric(label=col_titles[i], value=val)
-
-st.header("Analysis / COMPOUND:")
-
-############### Display Pie chart of all stint usages. ###############
-st.subheader('Number of times compound was used')
-generate_pie_chart(compound_df, 'compound_stint_count', 'compound', altair_color_dict)
-generate_value_columns(pivot_compound_vs_stint, compound_sum)
-
-############### Number of laps run / compound chart ###############
-st.subheader('Number of laps run per compound')
-generate_pie_chart(compound_df, 'compound_laps', 'compound', altair_color_dict)
-generate_value_columns(compound_df, compound_lap_count)
-
-
-############### Average life in laps / compound chart ###############
-st.subheader('Average Laps/Compound')
-generate_bar_chart(compound_df, 'compound', 'average_compound_laps', 'Compound', 'Laps')
-generate_value_columns(compound_df, average_compound_laps)
-
-############### Times/lap number per stint. ###############
-# Example: how fast on average is the first lap of a hard stint.
-st.subheader('Average lap speeds for given compounds (minus wet/int):')
-generate_value_columns(lapdf, get_avg_lap_times, col_titles=colTitles[:3])
-
-#Filter df.
-# tldf = lapdf.loc[~lapdf['compound'].isin(['WET', 'INTERMEDIATE'])]
-# pivot_percent_vs_compound = pd.pivot_table(tldf, values='lap_time_percentage_compared_to_average', index='lap_in_stint', columns=['compound'], aggfunc="mean")
-# pivot_seconds_vs_compound = pd.pivot_table(tldf, values='normalized_lap_seconds', index='lap_in_stint', columns=['compound'], aggfunc="mean")
-#
-# #Generate the color list from the compounds that exist.
-# streamlit_colors = [streamlit_color_dict[col] for col in pivot_seconds_vs_compound.columns]
-# st.line_chart(data=pivot_percent_vs_compound, color=streamlit_colors)
-# st.line_chart(data=pivot_seconds_vs_compound, color=streamlit_colors)
-
-st.subheader("During which stints was each compound used?")
-st.bar_chart(pivot_compound_vs_stint.T, stack=False, color=stint_color_list[:len(pivot_compound_vs_stint.index)])
-
-
-st.header("Analysis / STINT:")
-st.subheader('How often was each compound used for a given stint?')
-#Populates the altair color list with colors for compounds that exist in our filtered data.
-altair_color_list = [streamlit_color_dict[compound] for compound in pivot_compound_vs_stint.columns]
-st.bar_chart(pivot_compound_vs_stint, stack=False, color=altair_color_list)
-
-def avg_stint_laps(df, stint=0, avg_remaining=False):
-    if stint != 0:
-        if not avg_remaining:
-            return round(df.loc[stint, 'avg_stint_length'], 2) if stint in df.index else 'NA'
-        else:
-            return round(df.loc[stint:, 'avg_stint_length'].mean(), 2) if stint in df.index else 'NA'
-    return 'NA'
-
-def final_stint_count(df, stint=0, sum_remaining=False):
-    if stint != 0:
-        if not sum_remaining:
-            return round(df.loc[stint, 'final_stint_count'], 2) if stint in df.index else 'NA'
-        else:
-            return round(df.loc[stint:, 'final_stint_count'].sum(), 2) if stint in df.index else 'NA'
-    return 'NA'
-
-st.subheader('Stats per stint:')
-s1col, s2col, s3col, s4col = st.columns(4)
-with s1col:
-    st.subheader("1ST:")
-    st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 1))
-    st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 1))
-    st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(lapdf, stint='1'))
-with s2col:
-    st.subheader("2nd:")
-    st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 2))
-    st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 2))
-    st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(lapdf, stint='2'))
-with s3col:
-    st.subheader("3rd:")
-    st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 3))
-    st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 3))
-    st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(lapdf, stint='3'))
-with s4col:
-    st.subheader("4th and Up:")
-    st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 4, avg_remaining=True))
-    st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 4, sum_remaining=True))
-    st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(lapdf, stint='4', addl_stints=True))
-
-st.text('''* Lap times have been filtered and adjusted in an attempt to normalize them over 
+                return round(df.loc[stint:, 'final_stint_count'].sum(), 2) if stint in df.index else 'NA'
+        return 'NA'
+
+    st.subheader('Stats per stint:')
+    s1col, s2col, s3col, s4col = st.columns(4)
+    with s1col:
+        st.subheader("1ST:")
+        st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 1))
+        st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 1))
+        st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(metric_cube, stint='1'))
+    with s2col:
+        st.subheader("2nd:")
+        st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 2))
+        st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 2))
+        st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(metric_cube, stint='2'))
+    with s3col:
+        st.subheader("3rd:")
+        st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 3))
+        st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 3))
+        st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(metric_cube, stint='3'))
+    with s4col:
+        st.subheader("4th and Up:")
+        st.metric(label="Avg Length (Laps):", value=avg_stint_laps(stint_df, 4, avg_remaining=True))
+        st.metric(label="Final Stint Count:", value=final_stint_count(stint_df, 4, sum_remaining=True))
+        st.metric(label="*Avg Lap Time (s):", value=get_avg_lap_times(metric_cube, stint='4', addl_stints=True))
+
+    st.text('''* Lap times have been filtered and adjusted in an attempt to normalize them over 
 the course of a standard length race: This includes cutting out extreme outliers,
 and attempting to remove any laps that may have been artificially slowed (yellow flag, 
 pit out laps, standing starts, etc...). Lap times have also been adjusted to attempt 
 to account for weight loss due to fuel consumption assuming a (probably overly) simple
 linear relationship.''')
+
+    profiler.mark('full_render', script_start)
+    if show_stage_timings:
+        show_stage_timings_panel()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules in Source import each other by name, the way the dashboard and benchmark run them.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Source'))
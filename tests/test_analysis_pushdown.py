@@ -0,0 +1,122 @@
+"""
+The season load path filters sessions before the join, reads masters with filters, and builds the lap partials in
+one fused pass. These tests check each against the eager path it replaced, on synthetic seasons.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import SyntheticSeasonGenerator
+from data_formatter import DataFormatter
+from data_import import DataUtility
+
+join_keys = ['session_key', 'driver_number', 'lap_number']
+partial_keys = ['track_name', 'driver_name', 'compound']
+
+
+@pytest.fixture(scope='module')
+def generator():
+    return SyntheticSeasonGenerator(seasons=1, drivers=20, seed=3)
+
+
+@pytest.fixture(scope='module')
+def masters(generator):
+    du = DataUtility()
+    lapdf, sessiondf = generator.masters()
+    return du.apply_master_schema(lapdf, du.lap_master_dtypes), du.apply_master_schema(sessiondf, du.session_master_dtypes)
+
+
+@pytest.fixture(scope='module')
+def lapdf(masters):
+    du = DataUtility()
+    dc = DataFormatter()
+    lapdf, sessiondf = masters
+    return dc.normalize_lap_times(dc.remove_invalid_lap_times(du.combine_laps_and_session(lapdf[du.lap_analysis_columns], sessiondf)))
+
+
+def eager_combine(du, lapdf, sessiondf):
+    # Join every stint's laps first, then clean the joined frame.
+    return du.clean_df(lapdf.merge(du.expand_stints_to_laps(sessiondf), on=join_keys)).reset_index(drop=True)
+
+
+def eager_lap_time_partials(lapdf):
+    return (lapdf.groupby(['track_name', 'driver_name', 'compound', 'stint_number'], observed=True)['normalized_lap_seconds']
+            .agg(['sum', 'count'])
+            .rename(columns={'sum': 'lap_seconds_sum', 'count': 'lap_count'}))
+
+
+def eager_degradation_partials(lapdf):
+    lapdf = lapdf.loc[lapdf['normalized_lap_seconds'].notna() & lapdf['initial_tire_age'].notna()]
+    lap_in_stint = lapdf['lap_in_stint'].to_numpy(dtype=np.float64)
+    terms = {'intercept': np.ones(len(lapdf)),
+             'lap_in_stint': lap_in_stint,
+             'lap_in_stint_sq': lap_in_stint ** 2,
+             'initial_tire_age': lapdf['initial_tire_age'].to_numpy(dtype=np.float64)}
+    y = lapdf['normalized_lap_seconds'].to_numpy(dtype=np.float64)
+    names = DataFormatter.degradation_terms['curve']
+    products = {}
+    for i, a in enumerate(names):
+        for b in names[i:]:
+            products[f'xtx_{a}_{b}'] = terms[a] * terms[b]
+    for a in names:
+        products[f'xty_{a}'] = terms[a] * y
+    products['yty'] = y * y
+    products.update({key: lapdf[key].to_numpy() for key in partial_keys})
+    partials = pd.DataFrame(products).groupby(partial_keys, observed=True).sum()
+    partials['max_lap_in_stint'] = lapdf.groupby(partial_keys, observed=True)['lap_in_stint'].max()
+    return partials
+
+
+def test_combine_laps_and_session_matches_eager_join(masters):
+    du = DataUtility()
+    lapdf, sessiondf = masters
+    lapdf = lapdf[du.lap_analysis_columns]
+    combined = du.combine_laps_and_session(lapdf, sessiondf)
+    # The generated sessions include sprints, which clean_df drops.
+    assert len(combined) < len(lapdf.merge(du.expand_stints_to_laps(sessiondf), on=join_keys))
+    pd.testing.assert_frame_equal(combined, eager_combine(du, lapdf, sessiondf))
+
+
+@pytest.mark.parametrize('master_format', ['parquet', 'csv'])
+def test_load_masters_analysis_only_matches_full_load(masters, generator, tmp_path, monkeypatch, master_format):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Data').mkdir()
+    du = DataUtility()
+    du.master_format = master_format
+    year = generator.years[0]
+    lapdf, sessiondf = masters
+    du.write_master(lapdf, du.master_path(year, 'laps'))
+    du.write_master(sessiondf, du.master_path(year, 'session'))
+
+    analysis_laps, analysis_sessions = du.load_masters(year, analysis_only=True)
+    all_laps, all_sessions = du.load_masters(year)
+    assert set(analysis_sessions['session_name']) == {du.analysis_session_name}
+    assert len(analysis_laps) < len(all_laps)
+    # Filtered reads can keep categories no row uses any more, only the values need to match.
+    pd.testing.assert_frame_equal(du.combine_laps_and_session(analysis_laps, analysis_sessions),
+                                  eager_combine(du, all_laps, all_sessions), check_categorical=False)
+
+
+def test_lap_partials_match_separate_passes(lapdf):
+    lap_time_partials, degradation_partials = DataFormatter().lap_partials(lapdf)
+    pd.testing.assert_frame_equal(lap_time_partials, eager_lap_time_partials(lapdf), check_dtype=False)
+    # The separate pass grouped on plain values rather than the categoricals, compare the keys as values.
+    degradation_partials.index = pd.MultiIndex.from_tuples(degradation_partials.index.tolist(), names=partial_keys)
+    pd.testing.assert_frame_equal(degradation_partials.sort_index(), eager_degradation_partials(lapdf), check_dtype=False)
+
+
+def test_degradation_curve_stops_at_the_longest_fitted_stint(lapdf):
+    dc = DataFormatter()
+    _, degradation_partials = dc.lap_partials(lapdf)
+    # One driver at one track, so some compounds only have short stints.
+    track, driver = degradation_partials.index[0][:2]
+    selection = degradation_partials.xs((track, driver), level=['track_name', 'driver_name'], drop_level=False)
+    fits = dc.fit_degradation(selection, by=('compound',), within=('track_name', 'driver_name'))
+    curve = dc.degradation_curve(fits, max_lap=80)
+
+    fitted = lapdf.loc[(lapdf['track_name'] == track) & (lapdf['driver_name'] == driver)
+                       & lapdf['normalized_lap_seconds'].notna() & lapdf['initial_tire_age'].notna()]
+    longest = fitted.groupby('compound', observed=True)['lap_in_stint'].max()
+    for compound in curve.columns:
+        assert curve[compound].last_valid_index() == longest[compound]
+        assert curve[compound].loc[:longest[compound]].notna().all()
@@ -0,0 +1,74 @@
+"""
+Queries of the lap store (DataUtility.query_laps), built from the masters of a synthetic season.
+"""
+import pandas as pd
+import pytest
+
+from benchmark import SyntheticSeasonGenerator
+from data_formatter import DataFormatter
+from data_import import DataUtility
+
+pytest.importorskip('pyarrow')
+
+keys = ['session_key', 'driver_number', 'lap_number']
+
+
+@pytest.fixture
+def season(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Data').mkdir()
+    generator = SyntheticSeasonGenerator(seasons=1, drivers=20, seed=5)
+    year = generator.years[0]
+    du = DataUtility()
+    lapdf, sessiondf = generator.masters()
+    du.write_master(du.apply_master_schema(lapdf, du.lap_master_dtypes), du.master_path(year, 'laps'))
+    du.write_master(du.apply_master_schema(sessiondf, du.session_master_dtypes), du.master_path(year, 'session'))
+    return year
+
+
+def test_query_matches_season_laps(season):
+    du = DataUtility()
+    season_df = du.get_all_laps_and_sessions_per_year_df(season)
+    normalized = DataFormatter().clean_and_normalize(season_df)
+    driver = season_df['driver_name'].iloc[0]
+
+    # A track name that needs quoting in its partition directory.
+    laps = du.query_laps(drivers=[driver], tracks=['Monte Carlo'], years=[season])
+    expected = season_df.loc[(season_df['driver_name'] == driver) & (season_df['track_name'] == 'Monte Carlo')]
+    assert len(laps) == len(expected) > 0
+    assert set(laps['track_name']) == {'Monte Carlo'}
+    assert (laps['year'] == season).all()
+    pd.testing.assert_frame_equal(laps.sort_values(keys)[keys].reset_index(drop=True),
+                                  expected.sort_values(keys)[keys].reset_index(drop=True), check_dtype=False)
+
+    valid = du.query_laps(tracks=['Monte Carlo'], valid_only=True, columns=keys + ['normalized_lap_seconds'])
+    expected = normalized.loc[normalized['track_name'] == 'Monte Carlo', keys + ['normalized_lap_seconds']]
+    pd.testing.assert_frame_equal(valid.sort_values(keys).reset_index(drop=True),
+                                  expected.sort_values(keys).reset_index(drop=True), check_dtype=False)
+
+
+def test_query_rebuilds_after_masters_change(season):
+    du = DataUtility()
+    before = du.query_laps(years=[season], columns=keys + ['lap_seconds'])
+    lapdf = pd.read_parquet(du.master_path(season, 'laps'))
+    lapdf['lap_seconds'] += 1
+    du.write_master(lapdf, du.master_path(season, 'laps'))
+    after = du.query_laps(years=[season], columns=keys + ['lap_seconds'])
+    merged = before.merge(after, on=keys, suffixes=('_before', '_after'))
+    assert len(merged) == len(before)
+    assert ((merged['lap_seconds_after'] - merged['lap_seconds_before']).dropna().round(6) == 1).all()
+
+
+def test_query_without_seasons(season):
+    du = DataUtility()
+    columns = du.query_laps(years=[season]).columns
+    empty = du.query_laps(years=[], drivers=['X'])
+    assert len(empty) == 0
+    assert empty.columns.tolist() == columns.tolist()
+    assert du.query_laps(years=[], columns=['driver_name', 'year']).columns.tolist() == ['driver_name', 'year']
+
+
+def test_query_empty_data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Data').mkdir()
+    assert len(DataUtility().query_laps(drivers=['X'])) == 0
@@ -0,0 +1,69 @@
+"""
+DataFormatter.remove_invalid_lap_times against the merge based version it replaced, which must produce the same
+output bit for bit, and its return_mask form.
+"""
+import pandas as pd
+import pytest
+
+from benchmark import SyntheticSeasonGenerator
+from data_formatter import DataFormatter
+from data_import import DataUtility
+
+
+def merge_reference(df):
+    sddf = (df.groupby(['session_key', 'driver_name'], observed=True)
+            .agg({'lap_seconds': 'median',
+                  'lap_number': 'count'}))
+    sddf = sddf.rename(columns={'lap_number': 'session_laps'})
+    sddf['valid_lap_threshold'] = sddf['lap_seconds']*1.25
+    sddf = sddf[['session_laps', 'valid_lap_threshold']]
+    dfr = df.merge(sddf, on=['driver_name', 'session_key'])
+    dfs = dfr.groupby('session_key').agg({'session_laps': 'max'})
+    dfs['total_session_laps'] = dfs['session_laps'].apply(lambda x: x if x > 44 else 57)
+    dfr = dfr.merge(dfs, on=['session_key'])
+    dfr['lap_validity'] = True
+    dfr.loc[(dfr['lap_seconds'] >= dfr['valid_lap_threshold']) | (dfr['lap_seconds'].isnull()), 'lap_validity'] = False
+    dfvs = dfr.groupby(['session_key', 'lap_number']).agg({'lap_validity': 'sum'})
+    dfvs['field_valid_lap'] = dfvs['lap_validity'] > 10
+    dfvs = dfvs['field_valid_lap']
+    dfr = dfr.merge(dfvs, on=['session_key', 'lap_number'])
+    dfr = dfr.loc[(dfr['lap_validity'] == True) & (dfr['field_valid_lap'] == True)]
+    dfr = dfr.loc[dfr['is_pit_out_lap'] != True]
+    return dfr
+
+
+@pytest.fixture(scope='module')
+def season_df():
+    du = DataUtility()
+    lapdf, sessiondf = SyntheticSeasonGenerator(seasons=1, drivers=20, seed=7).masters()
+    lapdf = du.apply_master_schema(lapdf, du.lap_master_dtypes)
+    sessiondf = du.apply_master_schema(sessiondf, du.session_master_dtypes)
+    return du.combine_laps_and_session(lapdf[du.lap_analysis_columns], sessiondf)
+
+
+@pytest.fixture(params=['default_index', 'reversed_offset_index'])
+def laps(request, season_df):
+    if request.param == 'default_index':
+        return season_df
+    reversed_df = season_df.iloc[::-1]
+    return reversed_df.set_axis(pd.Index(range(len(reversed_df))) * 3 + 1000)
+
+
+def test_matches_merge_reference(laps):
+    result = DataFormatter().remove_invalid_lap_times(laps)
+    expected = merge_reference(laps)
+    assert 0 < len(result) < len(laps)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_mask_and_reasons(laps):
+    dc = DataFormatter()
+    mask, reasons = dc.remove_invalid_lap_times(laps, return_mask=True)
+    assert mask.index.equals(laps.index) and reasons.index.equals(laps.index)
+    assert mask.sum() == len(dc.remove_invalid_lap_times(laps))
+    assert reasons.columns.tolist() == ['invalid_lap_time', 'field_slow_lap', 'pit_out_lap']
+    # A lap is kept exactly when no reason drops it.
+    pd.testing.assert_series_equal(mask, ~reasons.any(axis=1), check_names=False)
+    pd.testing.assert_series_equal(reasons['pit_out_lap'], laps['is_pit_out_lap'] == True, check_names=False)
+    # Every reason actually occurs in a synthetic season.
+    assert reasons.any().all()
@@ -0,0 +1,67 @@
+"""
+Following a session live, against a replay of a synthetic race, must end up with what the batch pipeline makes of
+the finished session.
+"""
+import numpy as np
+import pytest
+
+from benchmark import SessionReplay, SyntheticSeasonGenerator
+from data_formatter import DataFormatter
+from data_import import DataUtility
+from live_session import LiveSession
+
+keys = ['driver_number', 'lap_number']
+
+
+@pytest.fixture(scope='module')
+def replay_frames():
+    frames = SyntheticSeasonGenerator(seasons=1, drivers=20, seed=3).generate()
+    sessions = frames['sessions']
+    session_key = int(sessions.loc[sessions['session_name'] == 'Race', 'session_key'].iloc[2])
+    return frames, session_key
+
+
+def batch_laps(du, session_key, driver_names):
+    lapdf = du.request_df('laps', {'session_key': str(session_key)}, cache=False, store=False,
+                          renames=du.lap_api_renames, dtypes=du.lap_master_dtypes)
+    lapdf['driver_name'] = lapdf['driver_number'].map(driver_names)
+    return lapdf
+
+
+def test_followed_session_matches_batch(replay_frames, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    frames, session_key = replay_frames
+    drivers = frames['drivers']
+    driver_names = drivers.loc[drivers['session_key'] == session_key].set_index('driver_number')['full_name']
+    dc = DataFormatter()
+    with SessionReplay(frames, session_key, speed=0) as api:
+        du = DataUtility()
+        du.api_url_base = api.api_url_base
+        live = LiveSession(session_key, du=du)
+        session_seconds = (api.lap_end.max() - api.session_start).total_seconds()
+        while api.elapsed() <= session_seconds:
+            api.advance(300)
+            live.poll()
+            # Lap validity and field slowing events agree with the batch rules at every point of the session.
+            lapdf = batch_laps(du, session_key, driver_names)
+            mask, reasons = dc.remove_invalid_lap_times(lapdf, return_mask=True)
+            batch = lapdf[keys].assign(valid=mask.to_numpy(), lap_validity=~reasons['invalid_lap_time'].to_numpy(),
+                                       field_valid_lap=~reasons['field_slow_lap'].to_numpy())
+            snapshot = live.snapshot()
+            compared = snapshot.merge(batch, on=keys, how='outer', suffixes=('', '_batch'), indicator=True)
+            assert (compared['_merge'] == 'both').all()
+            for col in ('valid', 'lap_validity', 'field_valid_lap'):
+                assert (compared[col] == compared[col + '_batch']).all(), col
+
+        assert live.poll() == 0
+        normalized = dc.normalize_lap_times(dc.remove_invalid_lap_times(batch_laps(du, session_key, driver_names)))
+    valid = live.snapshot().loc[lambda df: df['valid']]
+    compared = valid.merge(normalized, on=keys, suffixes=('', '_batch'))
+    assert len(compared) == len(valid) == len(normalized)
+    assert (compared['total_session_laps'] == compared['total_session_laps_batch']).all()
+    assert np.allclose(compared['normalized_lap_seconds'], compared['normalized_lap_seconds_batch'])
+    assert np.allclose(compared['average_normalized_lap_seconds'], compared['average_normalized_lap_seconds_batch'])
+    # Percentages are rounded to 2 places, running sums and the batch mean can round either way.
+    assert (compared['lap_time_percentage_compared_to_average']
+            - compared['lap_time_percentage_compared_to_average_batch']).abs().max() <= 0.01 + 1e-9
+    assert valid['driver_name'].notna().all()
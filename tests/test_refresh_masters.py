@@ -0,0 +1,60 @@
+"""
+Incremental refreshes of the season masters against a local stand-in for the api.
+"""
+import pandas as pd
+import pytest
+
+from benchmark import OpenF1StandIn, SyntheticSeasonGenerator
+from data_import import DataUtility
+
+
+@pytest.mark.parametrize('empty_endpoints', [('stints', 'laps'), ('drivers',)])
+def test_refresh_skips_started_race_without_data(tmp_path, monkeypatch, empty_endpoints):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Data').mkdir()
+    generator = SyntheticSeasonGenerator(seasons=1, drivers=20, seed=3)
+    frames = generator.generate()
+    year = generator.years[0]
+    races = frames['sessions'].loc[frames['sessions']['session_name'] == 'Race']
+    last_race = races.loc[pd.to_datetime(races['date_start']).idxmax(), 'session_key']
+
+    def without_last_race(endpoints):
+        return {endpoint: df.loc[df['session_key'] != last_race] if endpoint in endpoints else df
+                for endpoint, df in frames.items()}
+
+    du = DataUtility()
+    # The season before its last race.
+    with OpenF1StandIn(without_last_race(frames.keys())) as api:
+        du.api_url_base = api.api_url_base
+        lapdf, sessiondf = du.refresh_season_masters(year)
+    assert last_race not in set(sessiondf['session_key'])
+
+    # The last race has started, but the api has nothing for it yet.
+    with OpenF1StandIn(without_last_race(empty_endpoints)) as api:
+        du.api_url_base = api.api_url_base
+        refreshed_lapdf, refreshed_sessiondf = du.refresh_season_masters(year)
+    pd.testing.assert_frame_equal(refreshed_lapdf, lapdf)
+    pd.testing.assert_frame_equal(refreshed_sessiondf, sessiondf)
+    assert last_race not in du.read_manifest(year)
+
+    # Its data arrived, the next refresh picks it up.
+    with OpenF1StandIn(frames) as api:
+        du.api_url_base = api.api_url_base
+        lapdf, sessiondf = du.refresh_season_masters(year)
+    assert last_race in set(sessiondf['session_key'])
+    assert last_race in set(lapdf['session_key'])
+    assert last_race in du.read_manifest(year)
+
+
+def test_refresh_without_any_race_data(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Data').mkdir()
+    generator = SyntheticSeasonGenerator(seasons=1, drivers=20, seed=3)
+    frames = generator.generate()
+    frames = {endpoint: df if endpoint == 'sessions' else df.iloc[:0] for endpoint, df in frames.items()}
+    du = DataUtility()
+    with OpenF1StandIn(frames) as api:
+        du.api_url_base = api.api_url_base
+        lapdf, sessiondf = du.refresh_season_masters(generator.years[0])
+    assert len(lapdf) == len(sessiondf) == 0
+    assert du.load_masters(generator.years[0]) is None